@@ -1,13 +1,32 @@
 # bot.py
 import logging
 import asyncio
+import bisect
+import functools
+import io
+import math
 import os
+import secrets
+import signal
+import threading
+import time
 from datetime import datetime, timedelta
-from pyrogram import Client, filters
+from pyrogram import Client, filters, idle, raw, utils
+from pyrogram.enums import ChatMembersFilter
 from pyrogram.types import Message, ChatPrivileges, ChatMemberUpdated
-from pyrogram.errors import RPCError, FloodWait
-from config import API_ID, API_HASH, BOT_TOKEN, ADMIN_ID, TARGET_BOT_ID
+from pyrogram.errors import RPCError, FloodWait, PeerIdInvalid, UserAlreadyParticipant, UserNotParticipant
+from config import API_ID, API_HASH, BOT_TOKEN, ADMIN_ID, TARGET_BOT_ID, TRACE_FILE
 from database import MongoDB
+from ratelimit import RateLimiter
+from planner import build_plan, format_plan
+from notifier import AdminNotifier
+from rpc_errors import (
+    TRANSIENT, RATE_LIMITED, PERMANENT_CHAT, PERMANENT_PERMISSION, NEEDS_INVITE,
+    POLICIES, CIRCUIT_RESET, SESSION_ERRORS, RPC_EXCEPTIONS, UserPeerInvalid, classify, retry_delay
+)
+from registry import CAN_PROMOTE_MEMBERS, encode_privileges, privilege_names, to_chat_privileges
+from profiling import ENABLE_PROFILING, timed, instrument_logging, monitor_loop_lag, sample_thread, format_report
+from tracing import TraceRecorder, RECORDED_COMMANDS
 
 # Set up logging
 logging.basicConfig(
@@ -16,246 +35,402 @@ logging.basicConfig(
     handlers=[logging.FileHandler("bot.log"), logging.StreamHandler()]
 )
 logger = logging.getLogger(__name__)
+instrument_logging()
+
+# Pyrogram client whose RPCs pause while the session is being recovered
+class PromoterClient(Client):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rpc_ready = asyncio.Event()  # Cleared while recover_session() runs
+        self.rpc_ready.set()
+        self.recovery_lock = asyncio.Lock()
+        self.last_recovery = 0.0  # Monotonic time of the last successful recovery
+        self.restart_task = None  # Full restart scheduled when an in-place recovery failed
+        # Mirror every peer Pyrogram stores into the persistent resolution cache
+        self._store_peers = self.storage.update_peers
+        self.storage.update_peers = self.update_peers
+
+    async def update_peers(self, peers):
+        await self._store_peers(peers)
+        mongo_db.queue_peers(peers)
+
+    async def invoke(self, query, *args, **kwargs):
+        await self.rpc_ready.wait()
+        method = query.QUALNAME
+        # Don't spend a request on a method that is still penalized, even by a previous run
+        remaining = rate_limiter.flood_remaining(method)
+        if remaining:
+            if remaining > kwargs.get("sleep_threshold", self.sleep_threshold):
+                logger.warning(f"Not sending {method}: FloodWait has {remaining:.0f}s left")
+                raise FloodWait(value=math.ceil(remaining))
+            await asyncio.sleep(remaining)
+        rate_limiter.record_call(method)
+        try:
+            return await super().invoke(query, *args, **kwargs)
+        except FloodWait as e:
+            rate_limiter.record_flood(method, e.value)
+            # Persist right away so a restart during the wait still honours it
+            await save_rate_state()
+            raise
 
 # Initialize Pyrogram client and MongoDB
-app = Client(
+app = PromoterClient(
     "admin_promoter_bot",
     api_id=API_ID,
     api_hash=API_HASH,
     bot_token=BOT_TOKEN
 )
 mongo_db = MongoDB()
+rate_limiter = RateLimiter()
+notifier = AdminNotifier(ADMIN_ID, rate_limiter=rate_limiter)
+# Our own accounts keep their IDs so replayed handlers still match the config
+recorder = TraceRecorder(TRACE_FILE, keep_ids=[ADMIN_ID, TARGET_BOT_ID]) if TRACE_FILE else None
+
+SWEEP_INTERVAL = 3600  # Seconds between periodic admin status checks
+SWEEP_RETRY_DELAY = 300  # Seconds to wait before retrying a failed sweep
+SWEEP_SKIP_RECENT = 1800  # Seconds within which a chat verified by any instance is skipped by the sweep
+DIALOG_PAGE_SIZE = 100  # Dialogs fetched per GetDialogs page (Telegram's maximum)
+SWEEP_MAX_OFFSET_FAILURES = 3  # Failed sweeps from the same checkpoint before it is dropped
+SHUTDOWN_DRAIN_TIMEOUT = 30  # Seconds to let in-flight promotions finish on shutdown
+FLUSH_INTERVAL = 60  # Seconds between flushes of buffered chat and peer writes
+PEER_USERNAME_TTL = 86400  # Seconds a cached username -> user ID mapping is trusted
+RECOVERY_COOLDOWN = 10  # Seconds after a recovery during which new recovery requests are ignored
+PLAN_TTL = 600  # Seconds a /promoteall --plan result can be executed
+MEMBER_UPDATE_DEBOUNCE = 2.0  # Seconds to collect bursts of updates for the same chat member
+MEMBER_STATE_CACHE_SIZE = 10000  # Last handled member states kept for deduplication
+MAX_PROFILE_SECONDS = 300  # Longest /profile capture allowed
 
 # In-memory cache for invite links and pending promotions
 invite_cache = {}  # {chat_id: {user_id: {"link": str, "expires": datetime, "task": asyncio.Task}}}
 
+# In-memory caches warmed at startup
+bot_identity = None  # pyrogram.types.User for this bot
+promotion_plans = {}  # {plan_id: plan from planner.build_plan}
+pending_member_updates = {}  # {(chat_id, user_id): latest ChatMemberUpdated in the debounce window}
+handled_member_states = {}  # {(chat_id, user_id): (status, privileges bitmask)} last state handled
+member_update_tasks = set()  # Debounce timers, awaited on shutdown so no update is lost
+
+# Background tasks owned by the lifecycle manager
+promotion_tasks = set()  # In-flight promote_with_timeout tasks, drained on shutdown
+command_tasks = set()  # Running admin command handlers, drained on shutdown
+shutdown_started = asyncio.Event()  # Set by shutdown(); long commands stop at their next chat
+sweep_task = None  # Periodic check_all_chats_admin_status task
+sweep_chat_ids = []  # Sorted registry chat IDs a bot session's sweep pages through
+flush_task = None  # Periodic flush of buffered database writes
+lag_monitor_task = None  # Event-loop lag monitor, only when ENABLE_PROFILING is set
+change_watch_stop = threading.Event()  # Stops the MongoDB change watcher thread
+
+# Helper function to get this bot's identity without an RPC per call
+async def get_bot_identity(client: Client):
+    global bot_identity
+    if bot_identity is None:
+        bot_identity = await client.get_me()
+    return bot_identity
+
+# Helper function to resolve a username to a user ID, preferring the persistent peer cache
+@timed
+async def resolve_user_id(client: Client, username: str) -> int:
+    peer = mongo_db.get_peer_by_username(username, max_age=PEER_USERNAME_TTL)
+    if peer and peer["peer_type"] in ["user", "bot"]:
+        logger.info(f"Resolved @{username} to {peer['peer_id']} from peer cache")
+        return peer["peer_id"]
+    user = await client.get_users(username)
+    return user.id
+
+# Helper function to drop a pending invite here and for every other instance
+async def forget_invite(chat_id: int, user_id: int):
+    if chat_id in invite_cache and user_id in invite_cache[chat_id]:
+        del invite_cache[chat_id][user_id]
+        if not invite_cache[chat_id]:
+            del invite_cache[chat_id]
+    await asyncio.to_thread(mongo_db.delete_invite, chat_id, user_id)
+
+async def _promote_and_forget(client: Client, chat_id: int, user_id: int, bot_username: str):
+    try:
+        return await promote_with_timeout(client, chat_id, user_id, bot_username)
+    finally:
+        await forget_invite(chat_id, user_id)
+
+# Helper function to track a promotion task so shutdown can drain it
+def start_promotion_task(client: Client, chat_id: int, user_id: int, bot_username: str) -> asyncio.Task:
+    task = asyncio.create_task(_promote_and_forget(client, chat_id, user_id, bot_username))
+    promotion_tasks.add(task)
+    task.add_done_callback(promotion_tasks.discard)
+    return task
+
+# Decorator for admin command handlers so shutdown can wait for them and cancel them at its deadline
+def drained_command(handler):
+    @functools.wraps(handler)
+    async def wrapper(client: Client, message: Message):
+        if shutdown_started.is_set():
+            await message.reply("I'm shutting down, please retry once I'm back.")
+            return
+        # Run the handler in its own task: cancelling Pyrogram's handler worker would break Dispatcher.stop()
+        task = asyncio.create_task(handler(client, message))
+        command_tasks.add(task)
+        task.add_done_callback(command_tasks.discard)
+        await asyncio.wait([task])
+        if not task.cancelled():
+            return task.result()
+    return wrapper
+
+# Helper function to resolve a user peer on its own, so a failure to resolve it isn't blamed on the chat
+async def resolve_user_peer(client: Client, user_id: int):
+    try:
+        return await client.resolve_peer(user_id)
+    except PeerIdInvalid as e:
+        raise UserPeerInvalid() from e
+
+# Helper function to run an RPC under the retry policy of the error class it raises;
+# only chat-scoped calls (no user_id) count towards the chat's circuit breaker
+async def call_rpc(client: Client, call, description: str, chat_id: int = None, user_id: int = None):
+    attempt = 0
+    while True:
+        try:
+            if user_id is not None:
+                await resolve_user_peer(client, user_id)
+            result = await call()
+        except RPC_EXCEPTIONS as e:
+            error_class = classify(e)
+            # Unresolvable user peers are classified PERMANENT_USER, so only chat errors trip the circuit
+            if POLICIES[error_class].trips_circuit and chat_id is not None:
+                record_chat_failure(chat_id)
+            delay = retry_delay(e, attempt)
+            if delay is None:
+                raise
+            attempt += 1
+            logger.warning(
+                f"{description} failed ({error_class}), retry {attempt}/{POLICIES[error_class].retries} "
+                f"in {delay:.1f}s: {str(e)}"
+            )
+            if isinstance(e, SESSION_ERRORS):
+                await recover_session(client)
+            await asyncio.sleep(delay)
+            continue
+        if chat_id is not None:
+            reset_chat_failures(chat_id)
+        return result
+
+# Helper function to count a permanent chat error towards the chat's circuit breaker
+def record_chat_failure(chat_id: int):
+    record = mongo_db.chats.get(chat_id)
+    failures = (record.failures if record else 0) + 1
+    mongo_db.queue_chat_state(chat_id, {"failures": failures, "failed_at": datetime.utcnow()})
+
+# Helper function to close a chat's circuit again once it answers
+def reset_chat_failures(chat_id: int):
+    record = mongo_db.chats.get(chat_id)
+    if record and record.failures:
+        mongo_db.queue_chat_state(chat_id, {"failures": 0})
+
+# Helper function to check whether a chat's circuit is open, i.e. it should be skipped for now
+def circuit_open(chat_id: int) -> bool:
+    record = mongo_db.chats.get(chat_id)
+    return bool(
+        record and record.verdict == "dead"
+        and record.failed_at and time.time() - record.failed_at < CIRCUIT_RESET
+    )
+
 # Helper function to validate chat accessibility
+@timed
 async def is_chat_valid(client: Client, chat_id: int) -> bool:
     try:
-        await client.get_chat(chat_id)
+        await call_rpc(client, lambda: client.get_chat(chat_id), f"get_chat for chat {chat_id}", chat_id)
         logger.info(f"Chat {chat_id} is valid and accessible")
         return True
-    except RPCError as e:
+    except RPC_EXCEPTIONS as e:
         logger.error(f"Chat {chat_id} is invalid or inaccessible: {str(e)}")
         return False
 
 # Helper function to check if bot is admin with real-world promotion test
-async def is_bot_admin(client: Client, chat_id: int, max_retries: int = 3, retry_delay: float = 1.0) -> dict:
-    bot = await client.get_me()
-    for attempt in range(max_retries):
-        try:
-            # Primary check using get_chat_member
-            bot_member = await client.get_chat_member(chat_id, bot.id)
-            status = bot_member.status.value
-            logger.info(f"Primary admin check attempt {attempt + 1}/{max_retries} for chat {chat_id}: status={status}")
-            if status in ["administrator", "creator"]:
-                privileges = {
-                    "can_manage_chat": bot_member.privileges.can_manage_chat or False,
-                    "can_delete_messages": bot_member.privileges.can_delete_messages or False,
-                    "can_manage_video_chats": bot_member.privileges.can_manage_video_chats or False,
-                    "can_restrict_members": bot_member.privileges.can_restrict_members or False,
-                    "can_promote_members": bot_member.privileges.can_promote_members or False,
-                    "can_change_info": bot_member.privileges.can_change_info or False,
-                    "can_invite_users": bot_member.privileges.can_invite_users or False,
-                    "can_pin_messages": bot_member.privileges.can_pin_messages or False,
-                }
-                logger.info(f"Bot is admin in chat {chat_id}: privileges={privileges}")
-                # Verify required permissions
-                if not privileges["can_promote_members"]:
-                    logger.warning(f"Bot lacks 'can_promote_members' permission in chat {chat_id}")
-                    return {}
-                
-                # Test actual promotion capability with ADMIN_ID
-                chat = await client.get_chat(chat_id)
-                if chat.type in ["supergroup", "channel"]:
-                    try:
-                        test_privileges = ChatPrivileges(can_manage_chat=True)
-                        await client.promote_chat_member(
-                            chat_id=chat_id,
-                            user_id=ADMIN_ID,
-                            privileges=test_privileges
-                        )
-                        await client.promote_chat_member(
-                            chat_id=chat_id,
-                            user_id=ADMIN_ID,
-                            privileges=ChatPrivileges()
-                        )
-                        logger.info(f"Test promotion succeeded in chat {chat_id}")
-                    except RPCError as e:
-                        error_msg = str(e)
-                        logger.warning(f"Test promotion failed in chat {chat_id}: {error_msg}")
-                        if "CHAT_ADMIN_INVITE_REQUIRED" in error_msg:
-                            logger.warning(f"Missing required permission in chat {chat_id}")
-                            return {}
-                        if "USER_NOT_PARTICIPANT" in error_msg:
-                            logger.warning(f"ADMIN_ID not in chat {chat_id}, skipping test")
-                        else:
-                            logger.error(f"Test promotion error in chat {chat_id}: {error_msg}")
-                            return {}
-                    except Exception as e:
-                        logger.error(f"Unexpected error in test promotion for chat {chat_id}: {str(e)}")
-                        return {}
-                return privileges
-            
-            # Fallback check using get_chat_members with admin filter
-            logger.info(f"Fallback admin check attempt {attempt + 1}/{max_retries} for chat {chat_id}")
-            admins = await client.get_chat_members(chat_id, filter="administrators")
-            for admin in admins:
-                if admin.user.id == bot.id:
-                    privileges = {
-                        "can_manage_chat": admin.privileges.can_manage_chat or False,
-                        "can_delete_messages": admin.privileges.can_delete_messages or False,
-                        "can_manage_video_chats": admin.privileges.can_manage_video_chats or False,
-                        "can_restrict_members": admin.privileges.can_restrict_members or False,
-                        "can_promote_members": admin.privileges.can_promote_members or False,
-                        "can_change_info": admin.privileges.can_change_info or False,
-                        "can_invite_users": admin.privileges.can_invite_users or False,
-                        "can_pin_messages": admin.privileges.can_pin_messages or False,
-                    }
-                    logger.info(f"Bot found in admins list for chat {chat_id}: privileges={privileges}")
-                    if not privileges["can_promote_members"]:
-                        logger.warning(f"Bot lacks 'can_promote_members' permission in chat {chat_id}")
-                        return {}
-                    if chat.type in ["supergroup", "channel"]:
-                        try:
-                            await client.promote_chat_member(
-                                chat_id=chat_id,
-                                user_id=ADMIN_ID,
-                                privileges=ChatPrivileges(can_manage_chat=True)
-                            )
-                            await client.promote_chat_member(
-                                chat_id=chat_id,
-                                user_id=ADMIN_ID,
-                                privileges=ChatPrivileges()
-                            )
-                            logger.info(f"Test promotion succeeded in chat {chat_id}")
-                        except RPCError as e:
-                            error_msg = str(e)
-                            logger.warning(f"Test promotion failed in chat {chat_id}: {error_msg}")
-                            if "CHAT_ADMIN_INVITE_REQUIRED" in error_msg:
-                                logger.warning(f"Missing required permission in chat {chat_id}")
-                                return {}
-                            if "USER_NOT_PARTICIPANT" in error_msg:
-                                logger.warning(f"ADMIN_ID not in chat {chat_id}, skipping test")
-                            else:
-                                logger.error(f"Test promotion error in chat {chat_id}: {error_msg}")
-                                return {}
-                        except Exception as e:
-                            logger.error(f"Unexpected error in test promotion for chat {chat_id}: {str(e)}")
-                            return {}
-                    return privileges
+@timed
+async def is_bot_admin(client: Client, chat_id: int) -> int:
+    """Return the bot's privileges in chat_id as a bitmask, 0 if it can't promote there, or None if the check failed.
+
+    Both 0 and None are falsy, so callers that only need a yes/no can ignore the difference.
+    """
+    try:
+        bot = await get_bot_identity(client)
+        privileges = await call_rpc(
+            client, lambda: _check_bot_admin(client, chat_id),
+            f"Admin check for chat {chat_id}", chat_id, user_id=bot.id
+        )
+    except RPC_EXCEPTIONS as e:
+        logger.error(f"Failed to verify bot admin status in chat {chat_id}: {str(e)}")
+        return None
+    except Exception as e:
+        logger.error(f"Unexpected error during admin check for chat {chat_id}: {str(e)}")
+        return None
+    mongo_db.queue_chat_state(chat_id, {"privileges": privileges, "checked_at": datetime.utcnow()})
+    return privileges
+
+async def _check_bot_admin(client: Client, chat_id: int) -> int:
+    bot = await get_bot_identity(client)
+    # Primary check using get_chat_member
+    bot_member = await client.get_chat_member(chat_id, bot.id)
+    status = bot_member.status.value
+    logger.info(f"Primary admin check for chat {chat_id}: status={status}")
+    if status in ["administrator", "creator"]:
+        privileges = encode_privileges(bot_member.privileges)
+        logger.info(f"Bot is admin in chat {chat_id}: privileges={privilege_names(privileges)}")
+    else:
+        # Fallback check using get_chat_members with admin filter
+        logger.info(f"Fallback admin check for chat {chat_id}")
+        async for admin in client.get_chat_members(chat_id, filter=ChatMembersFilter.ADMINISTRATORS):
+            if admin.user.id == bot.id:
+                privileges = encode_privileges(admin.privileges)
+                logger.info(f"Bot found in admins list for chat {chat_id}: privileges={privilege_names(privileges)}")
+                break
+        else:
             logger.warning(f"Bot not found in admins list for chat {chat_id}")
-            return {}
-        
-        except FloodWait as e:
-            logger.warning(f"Flood wait {e.x}s during admin check for chat {chat_id}, attempt {attempt + 1}/{max_retries}")
-            await asyncio.sleep(e.x)
-        except RPCError as e:
-            logger.error(f"RPC error during admin check for chat {chat_id}, attempt {attempt + 1}/{max_retries}: {str(e)}")
-            if "RANDOM_ID_DUPLICATE" in str(e):
-                logger.warning("Detected RANDOM_ID_DUPLICATE, resetting session")
-                await reset_session(client)
-            if attempt < max_retries - 1:
-                await asyncio.sleep(retry_delay * (2 ** attempt))  # Exponential backoff
-        except Exception as e:
-            logger.error(f"Unexpected error during admin check for chat {chat_id}: {str(e)}")
-            return {}
-    logger.error(f"Failed to verify bot admin status in chat {chat_id} after {max_retries} attempts")
-    return {}
+            return 0
+    # Verify required permissions
+    if not privileges & CAN_PROMOTE_MEMBERS:
+        logger.warning(f"Bot lacks 'can_promote_members' permission in chat {chat_id}")
+        return 0
+    
+    # Test actual promotion capability with ADMIN_ID
+    chat = await client.get_chat(chat_id)
+    if chat.type in ["supergroup", "channel"] and not await _test_promotion(client, chat_id):
+        return 0
+    return privileges
+
+async def _test_promotion(client: Client, chat_id: int) -> bool:
+    try:
+        await client.promote_chat_member(
+            chat_id=chat_id,
+            user_id=ADMIN_ID,
+            privileges=ChatPrivileges(can_manage_chat=True)
+        )
+        await client.promote_chat_member(
+            chat_id=chat_id,
+            user_id=ADMIN_ID,
+            privileges=ChatPrivileges()
+        )
+        logger.info(f"Test promotion succeeded in chat {chat_id}")
+        return True
+    except RPCError as e:
+        error_class = classify(e)
+        logger.warning(f"Test promotion failed in chat {chat_id} ({error_class}): {str(e)}")
+        if error_class in [TRANSIENT, RATE_LIMITED]:
+            # Let call_rpc retry the whole admin check
+            raise
+        if error_class == NEEDS_INVITE:
+            logger.warning(f"ADMIN_ID not in chat {chat_id}, skipping test")
+            return True
+        return False
+
+# Helper function to cache a member's last seen status with the stored chat
+def remember_member_status(chat_id: int, user_id: int, status: str):
+    record = mongo_db.chats.get(chat_id)
+    if record is None:
+        return
+    members = record.members or {}
+    if members.get(str(user_id)) != status:
+        mongo_db.queue_chat_state(chat_id, {"members": {**members, str(user_id): status}})
 
 # Helper function to check if a user/bot is in the chat and their status
+@timed
 async def get_user_status(client: Client, chat_id: int, user_id: int) -> str:
     try:
-        member = await client.get_chat_member(chat_id, user_id)
+        member = await call_rpc(
+            client, lambda: client.get_chat_member(chat_id, user_id),
+            f"Status lookup of user {user_id} in chat {chat_id}", chat_id, user_id=user_id
+        )
         status = member.status.value
         logger.info(f"User {user_id} is in chat {chat_id} with status: {status}")
+        remember_member_status(chat_id, user_id, status)
         return status
-    except RPCError as e:
+    except RPC_EXCEPTIONS as e:
         logger.warning(f"User {user_id} not in chat {chat_id}: {str(e)}")
+        if isinstance(e, UserNotParticipant):
+            remember_member_status(chat_id, user_id, None)
         return None
 
 # Helper function to unban a user/bot from the chat
-async def unban_user(client: Client, chat_id: int, user_id: int, max_retries: int = 2) -> bool:
-    for attempt in range(max_retries):
-        try:
-            await client.unban_chat_member(chat_id, user_id)
-            logger.info(f"Successfully unbanned user {user_id} from chat {chat_id}")
-            return True
-        except RPCError as e:
-            logger.error(f"Failed to unban user {user_id} from chat {chat_id}, attempt {attempt + 1}/{max_retries}: {str(e)}")
-            if attempt < max_retries - 1:
-                await asyncio.sleep(2)
-        except Exception as e:
-            logger.error(f"Unexpected error unbanning user {user_id} from chat {chat_id}: {str(e)}")
-            return False
-    return False
+@timed
+async def unban_user(client: Client, chat_id: int, user_id: int) -> bool:
+    try:
+        await call_rpc(
+            client, lambda: client.unban_chat_member(chat_id, user_id),
+            f"Unban of user {user_id} in chat {chat_id}", chat_id, user_id=user_id
+        )
+        logger.info(f"Successfully unbanned user {user_id} from chat {chat_id}")
+        return True
+    except RPC_EXCEPTIONS as e:
+        logger.error(f"Failed to unban user {user_id} from chat {chat_id}: {str(e)}")
+        return False
+    except Exception as e:
+        logger.error(f"Unexpected error unbanning user {user_id} from chat {chat_id}: {str(e)}")
+        return False
 
 # Helper function to invite a user/bot to the chat
+@timed
 async def invite_user(client: Client, chat_id: int, user_id: int) -> bool:
+    add_member = lambda: client.add_chat_members(chat_id, [user_id])
     try:
-        chat = await client.get_chat(chat_id)
+        chat = await call_rpc(client, lambda: client.get_chat(chat_id), f"get_chat for chat {chat_id}", chat_id)
         if chat.type in ["supergroup", "channel"]:
             try:
                 # Try direct invite
-                await client.add_chat_members(chat_id, [user_id])
+                await call_rpc(client, add_member, f"Direct invite of user {user_id} to chat {chat_id}", chat_id, user_id=user_id)
                 logger.info(f"Successfully invited user {user_id} to chat {chat_id} via direct invite")
+                mongo_db.queue_chat_state(chat_id, {"invite_mode": "direct"})
                 return True
             except RPCError as e:
-                error_msg = str(e)
-                if "BOT_METHOD_INVALID" in error_msg or "USER_ALREADY_PARTICIPANT" in error_msg:
-                    logger.warning(f"Direct invite failed for user {user_id} in chat {chat_id}: {error_msg}")
+                if isinstance(e, UserAlreadyParticipant) or classify(e) == NEEDS_INVITE:
+                    logger.warning(f"Direct invite failed for user {user_id} in chat {chat_id}: {str(e)}")
                 else:
                     raise
         else:
-            await client.add_chat_members(chat_id, [user_id])
+            await call_rpc(client, add_member, f"Direct invite of user {user_id} to chat {chat_id}", chat_id, user_id=user_id)
             logger.info(f"Successfully invited user {user_id} to chat {chat_id} via direct invite")
             return True
-    except RPCError as e:
+    except RPC_EXCEPTIONS as e:
         error_msg = str(e)
         logger.warning(f"Direct invite attempt failed for user {user_id} in chat {chat_id}: {error_msg}")
-        if "BOT_METHOD_INVALID" in error_msg or "CHAT_WRITE_FORBIDDEN" in error_msg:
+        if classify(e) == NEEDS_INVITE:
             # Fallback to invite link
-            for attempt in range(2):
+            mongo_db.queue_chat_state(chat_id, {"invite_mode": "link"})
+            try:
+                # Create temporary invite link (expires in 1 minute, 1 user)
+                expire_date = datetime.utcnow() + timedelta(minutes=1)
+                invite_link = await call_rpc(
+                    client,
+                    lambda: client.create_chat_invite_link(chat_id, expire_date=expire_date, member_limit=1),
+                    f"Invite link creation for chat {chat_id}", chat_id
+                )
+                invite_link = invite_link.invite_link
+                # Store in cache for join detection
+                if chat_id not in invite_cache:
+                    invite_cache[chat_id] = {}
+                invite_cache[chat_id][user_id] = {
+                    "link": invite_link,
+                    "expires": expire_date,
+                    "task": None
+                }
+                await asyncio.to_thread(mongo_db.save_invite, chat_id, user_id, invite_link, expire_date)
+                # Send invite link to target bot
                 try:
-                    # Create temporary invite link (expires in 1 minute, 1 user)
-                    expire_date = datetime.utcnow() + timedelta(minutes=1)
-                    invite_link = await client.create_chat_invite_link(
-                        chat_id,
-                        expire_date=expire_date,
-                        member_limit=1
+                    await client.send_message(
+                        user_id,
+                        f"You've been invited to join chat {chat_id}. Please join within 1 minute using this link: {invite_link}"
+                    )
+                    logger.info(f"Sent invite link to user {user_id} for chat {chat_id}: {invite_link}")
+                except RPCError as msg_e:
+                    logger.warning(f"Failed to send invite link to user {user_id}: {str(msg_e)}")
+                    # Fallback to ADMIN_ID; the link expires in a minute so skip the digest
+                    await notifier.notify(
+                        "Invite links",
+                        f"Couldn't send invite link to @{user_id} for chat {chat_id}. "
+                        f"Please have @{user_id} join using this link within 1 minute: {invite_link}",
+                        urgent=True
                     )
-                    invite_link = invite_link.invite_link
-                    # Store in cache for join detection
-                    if chat_id not in invite_cache:
-                        invite_cache[chat_id] = {}
-                    invite_cache[chat_id][user_id] = {
-                        "link": invite_link,
-                        "expires": expire_date,
-                        "task": None
-                    }
-                    # Send invite link to target bot
-                    try:
-                        await client.send_message(
-                            user_id,
-                            f"You've been invited to join chat {chat_id}. Please join within 1 minute using this link: {invite_link}"
-                        )
-                        logger.info(f"Sent invite link to user {user_id} for chat {chat_id}: {invite_link}")
-                    except RPCError as msg_e:
-                        logger.warning(f"Failed to send invite link to user {user_id}: {str(msg_e)}")
-                        # Fallback to ADMIN_ID
-                        await client.send_message(
-                            ADMIN_ID,
-                            f"Couldn't send invite link to @{user_id} for chat {chat_id}. "
-                            f"Please have @{user_id} join using this link within 1 minute: {invite_link}"
-                        )
-                        logger.info(f"Sent invite link to ADMIN_ID for user {user_id} to join chat {chat_id}: {invite_link}")
-                    return False  # Indicate invite was not completed, but link was sent
-                except RPCError as link_e:
-                    logger.error(f"Failed to generate invite link for chat {chat_id}, attempt {attempt + 1}/2: {str(link_e)}")
-                    if attempt < 1:
-                        await asyncio.sleep(2)
-                    else:
-                        return False
+                    logger.info(f"Sent invite link to ADMIN_ID for user {user_id} to join chat {chat_id}: {invite_link}")
+                return False  # Indicate invite was not completed, but link was sent
+            except RPC_EXCEPTIONS as link_e:
+                logger.error(f"Failed to generate invite link for chat {chat_id}: {str(link_e)}")
+                return False
         else:
             logger.error(f"Failed to invite user {user_id} to chat {chat_id}: {error_msg}")
             return False
@@ -263,27 +438,95 @@ async def invite_user(client: Client, chat_id: int, user_id: int) -> bool:
         logger.error(f"Unexpected error inviting user {user_id} to chat {chat_id}: {str(e)}")
         return False
 
-# Helper function to reset Pyrogram session
-async def reset_session(client: Client):
-    try:
-        session_file = "admin_promoter_bot.session"
-        if os.path.exists(session_file):
-            os.remove(session_file)
-            logger.info("Deleted session file to reset session")
-        await client.stop()
-        await client.start()
-        logger.info("Session reset successfully")
-    except Exception as e:
-        logger.error("Failed to reset session: {str(e)}")
+# Helper function to recover the Pyrogram session in place
+@timed
+async def recover_session(client: PromoterClient):
+    """Reconnect the MTProto session without touching the session file or peer cache."""
+    loop = asyncio.get_running_loop()
+    if client.recovery_lock.locked():
+        # Another handler is already recovering; wait for it instead of resetting again
+        await client.rpc_ready.wait()
+        return
+    async with client.recovery_lock:
+        if loop.time() - client.last_recovery < RECOVERY_COOLDOWN:
+            logger.info("Session was recovered moments ago, skipping another recovery")
+            return
+        started = loop.time()
+        client.rpc_ready.clear()
+        try:
+            await client.session.restart()
+            client.last_recovery = loop.time()
+            logger.info(f"Session recovered in place in {(client.last_recovery - started) * 1000:.0f}ms")
+        except Exception as e:
+            logger.error(f"Failed to recover session in place, restarting the client: {str(e)}")
+            # client.stop() waits for every handler to return, this one included, so restart in the background
+            client.restart_task = asyncio.create_task(restart_client(client))
+        finally:
+            client.rpc_ready.set()
+
+# Helper function to fully stop and start the client when an in-place session restart failed
+async def restart_client(client: PromoterClient):
+    loop = asyncio.get_running_loop()
+    async with client.recovery_lock:
+        started = loop.time()
+        try:
+            await client.stop()
+            await client.start()
+            client.last_recovery = loop.time()
+            logger.info(f"Client restarted in {client.last_recovery - started:.1f}s")
+        except Exception as e:
+            # Nothing left to recover with; shut down cleanly so the supervisor can start a fresh process
+            logger.critical(f"Failed to restart the client, shutting down: {str(e)}")
+            os.kill(os.getpid(), signal.SIGTERM)
 
-# Handler for when the bot's chat member status is updated
+# Handler for chat member updates: coalesce bursts per (chat, member) before handling
 @app.on_chat_member_updated()
 async def on_chat_member_updated(client: Client, update: ChatMemberUpdated):
+    if recorder:
+        recorder.record_update(update)
+    member = update.new_chat_member or update.old_chat_member
+    key = (update.chat.id, member.user.id if member else None)
+    if key not in pending_member_updates:
+        task = asyncio.create_task(dispatch_member_update(client, key))
+        member_update_tasks.add(task)
+        task.add_done_callback(member_update_tasks.discard)
+    else:
+        logger.info(f"Coalescing chat member update for chat_id={key[0]}, user_id={key[1]}")
+    pending_member_updates[key] = update
+
+# Helper function to handle the final state of a debounced member update burst
+async def dispatch_member_update(client: Client, key: tuple):
+    await asyncio.sleep(MEMBER_UPDATE_DEBOUNCE)
+    update = pending_member_updates.pop(key)
+    new_member = update.new_chat_member
+    privileges = new_member.privileges if new_member else None
+    state = (
+        new_member.status.value if new_member else None,
+        encode_privileges(privileges)
+    )
+    if handled_member_states.get(key) == state:
+        logger.info(f"Skipping duplicate chat member update for chat_id={key[0]}, user_id={key[1]}")
+        return
+    try:
+        await handle_chat_member_update(client, update)
+    except Exception as e:
+        logger.error(f"Failed to handle chat member update for chat_id={key[0]}, user_id={key[1]}: {str(e)}")
+        return
+    # Only a handled state counts as a duplicate, so a failed one is handled again when it repeats
+    handled_member_states.pop(key, None)
+    handled_member_states[key] = state
+    if len(handled_member_states) > MEMBER_STATE_CACHE_SIZE:
+        handled_member_states.pop(next(iter(handled_member_states)))
+
+@timed
+async def handle_chat_member_update(client: Client, update: ChatMemberUpdated):
     chat = update.chat
     new_member = update.new_chat_member
     logger.info(f"Chat member update: chat_id={chat.id}, user_id={new_member.user.id if new_member else None}, status={new_member.status.value if new_member else None}")
+    if new_member:
+        remember_member_status(chat.id, new_member.user.id, new_member.status.value)
     
-    bot = await client.get_me()
+    bot = await get_bot_identity(client)
     chat_id = chat.id
     chat_title = chat.title or str(chat_id)
     chat_type = chat.type.value
@@ -292,34 +535,32 @@ async def on_chat_member_updated(client: Client, update: ChatMemberUpdated):
     if new_member and new_member.user.id == bot.id and new_member.status.value in ["member", "administrator", "creator"]:
         if chat_type in ["group", "supergroup", "channel"]:
             privileges = await is_bot_admin(client, chat_id)
+            if privileges is None:
+                # Raise so dispatch_member_update doesn't record this state and a repeat gets checked again
+                await notifier.notify(
+                    "Admin check failures",
+                    f"Couldn't verify my permissions in {chat_type} {chat_title} (ID: {chat_id}); will check again on the next update."
+                )
+                raise RuntimeError(f"Admin check failed in chat {chat_id}")
             if privileges:
-                if mongo_db.save_chat(chat_id, chat_type, chat_title):
-                    try:
-                        await client.send_message(
-                            ADMIN_ID,
-                            f"Bot promoted to admin in {chat_type} {chat_title} (ID: {chat_id}) and saved to database"
-                        )
-                        logger.info(f"Saved chat {chat_id} ({chat_title}, type: {chat_type}) to database")
-                    except Exception as e:
-                        logger.error(f"Failed to notify ADMIN_ID for chat {chat_id}: {str(e)}")
+                if mongo_db.save_chat(chat_id, chat_type, chat_title, privileges):
+                    await notifier.notify(
+                        "Chats saved",
+                        f"Bot promoted to admin in {chat_type} {chat_title} (ID: {chat_id}) and saved to database"
+                    )
+                    logger.info(f"Saved chat {chat_id} ({chat_title}, type: {chat_type}) to database")
                 else:
-                    try:
-                        await client.send_message(
-                            ADMIN_ID,
-                            f"Failed to save {chat_type} {chat_title} (ID: {chat_id}) to database"
-                        )
-                    except Exception as e:
-                        logger.error(f"Failed to notify ADMIN_ID for chat {chat_id}: {str(e)}")
-            else:
-                try:
-                    await client.send_message(
-                        ADMIN_ID,
-                        f"Bot added to {chat_type} {chat_title} (ID: {chat_id}) but lacks required permissions. "
-                        "Please grant 'Invite Users via Link', 'Ban Members', and 'Add New Admins' permissions in chat settings."
+                    await notifier.notify(
+                        "Database errors",
+                        f"Failed to save {chat_type} {chat_title} (ID: {chat_id}) to database"
                     )
-                    logger.info(f"Bot not an admin in {chat_id}, requested permissions")
-                except Exception as e:
-                    logger.error(f"Failed to notify ADMIN_ID for chat {chat_id}: {str(e)}")
+            else:
+                await notifier.notify(
+                    "Missing permissions",
+                    f"Bot added to {chat_type} {chat_title} (ID: {chat_id}) but lacks required permissions. "
+                    "Please grant 'Invite Users via Link', 'Ban Members', and 'Add New Admins' permissions in chat settings."
+                )
+                logger.info(f"Bot not an admin in {chat_id}, requested permissions")
         else:
             logger.info(f"Ignored chat {chat_id}: type {chat_type} is not group/supergroup/channel")
     
@@ -338,58 +579,330 @@ async def on_chat_member_updated(client: Client, update: ChatMemberUpdated):
                 privileges = await is_bot_admin(client, chat_id)
                 if not privileges:
                     logger.warning(f"Cannot promote user {user_id} in chat {chat_id}: Bot lacks admin permissions")
-                    await client.send_message(
-                        ADMIN_ID,
+                    await notifier.notify(
+                        "Missing permissions",
                         f"Cannot promote @{user_id} in {chat_type} {chat_title} (ID: {chat_id}): I lack admin permissions."
                     )
                     return
                 
-                await client.promote_chat_member(
-                    chat_id=chat_id,
-                    user_id=user_id,
-                    privileges=ChatPrivileges(**privileges)
+                await call_rpc(
+                    client,
+                    lambda: client.promote_chat_member(chat_id, user_id, to_chat_privileges(privileges)),
+                    f"Promotion of user {user_id} in chat {chat_id}", chat_id, user_id=user_id
                 )
-                await client.send_message(
-                    ADMIN_ID,
+                await notifier.notify(
+                    "Promotions",
                     f"Successfully promoted @{user_id} to admin in {chat_type} {chat_title} (ID: {chat_id}) after joining via invite link"
                 )
                 logger.info(f"Promoted user {user_id} in chat {chat_id} after joining")
             except Exception as e:
                 logger.error(f"Failed to promote user {user_id} in chat {chat_id} after joining: {str(e)}")
-                await client.send_message(
-                    ADMIN_ID,
+                await notifier.notify(
+                    "Failed promotions",
                     f"Failed to promote @{user_id} in {chat_type} {chat_title} (ID: {chat_id}) after joining: {str(e)}"
                 )
             finally:
                 # Clean up cache
-                if chat_id in invite_cache and user_id in invite_cache[chat_id]:
-                    del invite_cache[chat_id][user_id]
-                    if not invite_cache[chat_id]:
-                        del invite_cache[chat_id]
+                await forget_invite(chat_id, user_id)
+
+# Helper function to fetch one page of dialogs as (chat_id, chat_type, chat_title) tuples
+async def fetch_dialog_page(client: Client, offset: dict) -> tuple:
+    """Return (chats, next_offset); next_offset is None once the last page has been read."""
+    offset_peer = await client.resolve_peer(offset["peer"]) if offset["peer"] else raw.types.InputPeerEmpty()
+    r = await client.invoke(
+        raw.functions.messages.GetDialogs(
+            offset_date=offset["date"],
+            offset_id=offset["id"],
+            offset_peer=offset_peer,
+            limit=DIALOG_PAGE_SIZE,
+            hash=0
+        ),
+        sleep_threshold=60
+    )
+    dialogs = [dialog for dialog in r.dialogs if isinstance(dialog, raw.types.Dialog)]
+    if not dialogs:
+        return [], None
+    raw_chats = {
+        (-chat.id if isinstance(chat, (raw.types.Chat, raw.types.ChatForbidden)) else utils.get_channel_id(chat.id)): chat
+        for chat in r.chats
+    }
+    messages = {(utils.get_peer_id(message.peer_id), message.id): message
+                for message in r.messages if not isinstance(message, raw.types.MessageEmpty)}
+    chats = []
+    for dialog in dialogs:
+        chat = raw_chats.get(utils.get_peer_id(dialog.peer))
+        if isinstance(chat, raw.types.Chat):
+            chats.append((-chat.id, "group", chat.title))
+        elif isinstance(chat, raw.types.Channel):
+            chats.append((utils.get_channel_id(chat.id), "channel" if chat.broadcast else "supergroup", chat.title))
+    last = dialogs[-1]
+    last_peer = utils.get_peer_id(last.peer)
+    top_message = messages.get((last_peer, last.top_message))
+    if len(dialogs) < DIALOG_PAGE_SIZE or top_message is None:
+        return chats, None
+    return chats, {"date": top_message.date, "id": last.top_message, "peer": last_peer}
+
+# Helper function to page through stored chats due a check in chat ID order, for sessions that can't list dialogs
+def fetch_registry_page(offset: dict) -> tuple:
+    """Return (chats, next_offset) for the chats after offset["after"]; next_offset is None after the last page."""
+    global sweep_chat_ids
+    # Sort once per pass (or after a restart) rather than once per page
+    if offset["after"] is None or not sweep_chat_ids:
+        sweep_chat_ids = sorted(
+            record.chat_id for record in mongo_db.chats.stale(SWEEP_SKIP_RECENT, retry_dead_after=CIRCUIT_RESET)
+        )
+    start = 0 if offset["after"] is None else bisect.bisect_right(sweep_chat_ids, offset["after"])
+    page = sweep_chat_ids[start:start + DIALOG_PAGE_SIZE]
+    records = [mongo_db.chats.get(chat_id) for chat_id in page]
+    chats = [(record.chat_id, record.chat_type, record.title) for record in records if record]
+    if start + DIALOG_PAGE_SIZE >= len(sweep_chat_ids):
+        return chats, None
+    return chats, {"after": page[-1]}
+
+# Helper function to fetch the next page of chats to sweep
+async def fetch_sweep_page(client: Client, offset: dict) -> tuple:
+    # messages.GetDialogs is only available to user accounts, so bots sweep the chats they have stored
+    if (await get_bot_identity(client)).is_bot:
+        return fetch_registry_page(offset)
+    return await fetch_dialog_page(client, offset)
 
 # Periodic task to check admin status in all chats
 async def check_all_chats_admin_status(client: Client):
+    failed_checkpoint, checkpoint_failures = None, 0
     while True:
+        next_page = None
+        checkpoint = None
         try:
-            async for dialog in client.get_dialogs():
-                chat = dialog.chat
-                chat_id = chat.id
-                chat_type = chat.type.value
-                chat_title = chat.title or str(chat_id)
-                if chat_type in ["group", "supergroup", "channel"]:
+            is_bot = (await get_bot_identity(client)).is_bot
+            # Resume an interrupted sweep (error or restart) from its last checkpoint
+            checkpoint = await asyncio.to_thread(mongo_db.get_sweep_checkpoint)
+            if checkpoint and is_bot != ("after" in checkpoint):
+                # Saved by the other kind of session; its offset means nothing here
+                checkpoint = None
+            if checkpoint:
+                logger.info(f"Resuming periodic check from offset {checkpoint}")
+                offset = checkpoint
+            else:
+                offset = {"after": None} if is_bot else {"date": 0, "id": 0, "peer": None}
+            next_page = asyncio.create_task(fetch_sweep_page(client, offset))
+            while next_page:
+                chats, offset = await next_page
+                # Fetch page N+1 while page N is being verified
+                next_page = asyncio.create_task(fetch_sweep_page(client, offset)) if offset else None
+                for chat_id, chat_type, chat_title in chats:
+                    # Another instance (or an earlier pass) may have verified this chat already,
+                    # and dead chats wait out their circuit before being probed again
+                    if not mongo_db.chats.is_stale(chat_id, SWEEP_SKIP_RECENT, retry_dead_after=CIRCUIT_RESET):
+                        continue
                     privileges = await is_bot_admin(client, chat_id)
                     if privileges:
-                        if mongo_db.save_chat(chat_id, chat_type, chat_title):
-                            logger.info(f"Periodic check: Saved chat {chat_id} ({chat_title}, type: {chat_type}) to database")
-                        else:
-                            logger.error(f"Periodic check: Failed to save chat {chat_id} to database")
-            await asyncio.sleep(3600)  # Run every hour
+                        mongo_db.queue_chat(chat_id, chat_type, chat_title, privileges)
+                        logger.info(f"Periodic check: Queued chat {chat_id} ({chat_title}, type: {chat_type}) for saving")
+                # Persist this page's results before moving the checkpoint past it
+                await asyncio.to_thread(mongo_db.flush_pending)
+                await asyncio.to_thread(mongo_db.save_sweep_checkpoint, offset)
+                checkpoint = offset
+            logger.info("Periodic check: Completed a full pass over all chats")
+            failed_checkpoint, checkpoint_failures = None, 0
+            await asyncio.sleep(SWEEP_INTERVAL)
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
             logger.error(f"Error in periodic admin status check: {str(e)}")
-            await asyncio.sleep(300)  # Retry after 5 minutes if error
+            if checkpoint is not None and checkpoint == failed_checkpoint:
+                checkpoint_failures += 1
+            else:
+                failed_checkpoint, checkpoint_failures = checkpoint, 1
+            if checkpoint is not None and checkpoint_failures >= SWEEP_MAX_OFFSET_FAILURES:
+                # The page after this checkpoint keeps failing; start the next pass from the top instead
+                logger.warning(f"Periodic check failed {checkpoint_failures} times from offset {checkpoint}, dropping it")
+                await asyncio.to_thread(mongo_db.save_sweep_checkpoint, None)
+                failed_checkpoint, checkpoint_failures = None, 0
+            await asyncio.sleep(SWEEP_RETRY_DELAY)
+        finally:
+            if next_page and not next_page.done():
+                next_page.cancel()
+
+# Helper function to start the periodic sweep unless it is already running
+def start_sweep(client: Client) -> bool:
+    global sweep_task
+    if sweep_task and not sweep_task.done():
+        return False
+    sweep_task = asyncio.create_task(check_all_chats_admin_status(client))
+    if recorder:
+        recorder.record_sweep()
+    return True
+
+# Periodic task to flush buffered chat and peer writes
+async def flush_pending_writes():
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        await asyncio.to_thread(mongo_db.flush_pending)
+        await save_rate_state()
+        prune_expired_invites()
+
+# Helper function to drop expired invites nobody is waiting on, e.g. ones whose delete event was missed
+def prune_expired_invites():
+    now = datetime.utcnow()
+    pruned = 0
+    for chat_id in list(invite_cache):
+        for user_id, entry in list(invite_cache[chat_id].items()):
+            # Entries with a running promotion task are forgotten by that task when it ends
+            if entry["expires"] < now and (entry["task"] is None or entry["task"].done()):
+                del invite_cache[chat_id][user_id]
+                pruned += 1
+        if not invite_cache[chat_id]:
+            del invite_cache[chat_id]
+    if pruned:
+        logger.info(f"Pruned {pruned} expired invites from the invite cache")
+
+# Helper function to persist FloodWait deadlines and recent calls for the next run
+async def save_rate_state():
+    await asyncio.to_thread(mongo_db.save_rate_state, rate_limiter.snapshot())
+
+# Helper function to start throttled where the previous run left off
+async def warm_rate_limiter():
+    state = await asyncio.to_thread(mongo_db.get_rate_state)
+    if not state:
+        return
+    rate_limiter.restore(state)
+    logger.info(
+        f"Restored rate limiter state: {sum(len(calls) for calls in rate_limiter.calls.values())} recent calls, "
+        f"{rate_limiter.flood_remaining():.0f}s left on the longest FloodWait"
+    )
+
+# Helper function to load stored chats into the registry
+async def warm_chat_caches():
+    chats = await asyncio.to_thread(mongo_db.warm_cache)
+    logger.info(
+        f"Warmed chat registry with {len(chats)} chats "
+        f"({len(chats.promotable())} promotable, {len(chats.dead())} dead)"
+    )
+
+# Helper function to apply a change made by another instance; runs on the event loop
+def apply_remote_change(collection: str, operation: str, document: dict):
+    if collection == "chats":
+        mongo_db.apply_chat_change(operation, document)
+        return
+    chat_id, user_id = document["chat_id"], document["user_id"]
+    if operation == "delete":
+        # Whoever deleted the invite has handled the join, so stop waiting for it here
+        entry = invite_cache.get(chat_id, {}).pop(user_id, None)
+        if chat_id in invite_cache and not invite_cache[chat_id]:
+            del invite_cache[chat_id]
+        if entry and entry["task"] and not entry["task"].done():
+            entry["task"].cancel()
+    else:
+        invite_cache.setdefault(chat_id, {}).setdefault(
+            user_id, {"link": document["link"], "expires": document["expires"], "task": None}
+        )
+
+# Helper function to reload chats and invites after the change stream lost track of changes
+async def resync_db_caches():
+    generation = mongo_db.flush_generation
+    docs = await asyncio.to_thread(mongo_db.get_all_chats)
+    mongo_db.resync_chats(docs, generation)
+    logger.info(f"Resynced chat registry with {len(docs)} stored chats")
+    # Missed invite deletions aren't inferred; prune_expired_invites() drops those entries once they expire
+    await warm_pending_invites()
+
+# Helper function to start the thread that follows changes from other instances
+def start_change_watcher():
+    loop = asyncio.get_running_loop()
+
+    def on_change(*change):
+        loop.call_soon_threadsafe(apply_remote_change, *change)
+
+    def on_resync():
+        asyncio.run_coroutine_threadsafe(resync_db_caches(), loop)
+
+    threading.Thread(
+        target=mongo_db.watch_changes,
+        args=(on_change, change_watch_stop),
+        kwargs={"on_resync": on_resync},
+        name="mongo-change-watcher",
+        daemon=True
+    ).start()
+
+# Helper function to load invites still pending from before a restart or on other instances
+async def warm_pending_invites():
+    invites = await asyncio.to_thread(mongo_db.get_pending_invites)
+    for invite in invites:
+        apply_remote_change("pending_invites", "insert", invite)
+    logger.info(f"Warmed invite cache with {len(invites)} pending invites")
+
+# Helper function to replay persisted peers into Pyrogram's storage
+async def warm_peer_cache(client: Client):
+    peers = await asyncio.to_thread(mongo_db.warm_peers)
+    await client.storage.update_peers([
+        (peer["peer_id"], peer["access_hash"], peer["peer_type"], peer.get("username"), None)
+        for peer in peers
+    ])
+    logger.info(f"Warmed peer cache with {len(peers)} peers")
+
+# Helper function to warm everything stored in MongoDB; main() has already connected
+async def warm_db_caches(client: Client):
+    await asyncio.gather(warm_chat_caches(), warm_peer_cache(client), warm_pending_invites())
+
+# Bring the bot to a ready state after the client has started
+async def startup(client: Client):
+    global flush_task, lag_monitor_task
+    started = datetime.utcnow()
+    # Start the notifier first so notices raised while warming up go out promptly
+    notifier.start(client)
+    await asyncio.gather(get_bot_identity(client), warm_db_caches(client))
+    if recorder:
+        await recorder.start(client, mongo_db, bot_identity)
+    flush_task = asyncio.create_task(flush_pending_writes())
+    start_change_watcher()
+    if ENABLE_PROFILING:
+        lag_monitor_task = asyncio.create_task(monitor_loop_lag())
+    start_sweep(client)
+    logger.info(f"Startup complete in {(datetime.utcnow() - started).total_seconds():.2f}s")
+
+# Helper function to let tasks finish until the shutdown deadline, cancelling whatever is left
+async def drain_tasks(tasks: set, description: str, deadline: float):
+    if not tasks:
+        return
+    timeout = max(deadline - asyncio.get_running_loop().time(), 0)
+    logger.info(f"Draining {len(tasks)} in-flight {description} (timeout {timeout:.0f}s)")
+    done, pending = await asyncio.wait(set(tasks), timeout=timeout)
+    for task in pending:
+        task.cancel()
+    if pending:
+        await asyncio.gather(*pending, return_exceptions=True)
+        logger.warning(f"Cancelled {len(pending)} {description} that did not finish before shutdown")
+
+# Drain in-flight work and flush pending writes before the client stops
+async def shutdown(client: Client, timeout: float = SHUTDOWN_DRAIN_TIMEOUT):
+    change_watch_stop.set()
+    shutdown_started.set()
+    # Commands, member updates and promotions share one drain deadline. Commands go first
+    # since they can start promotions, and everything drains before the final flush below
+    deadline = asyncio.get_running_loop().time() + timeout
+    await drain_tasks(command_tasks, "commands", deadline)
+    await drain_tasks(member_update_tasks, "member updates", deadline)
+    for task in [sweep_task, flush_task, lag_monitor_task]:
+        if task and not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+    await drain_tasks(promotion_tasks, "promotions", deadline)
+    await notifier.stop()
+    flushed = await asyncio.to_thread(mongo_db.flush_pending)
+    await save_rate_state()
+    if recorder:
+        recorder.close()
+    logger.info(f"Shutdown complete, flushed {flushed} pending writes")
+
+# Record admin commands for replay.py before their handlers run
+@app.on_message(filters.command(RECORDED_COMMANDS) & filters.user(ADMIN_ID), group=-1)
+async def record_command(client: Client, message: Message):
+    if recorder:
+        recorder.record_command(message)
 
 # Command to manually add the current chat to the database
 @app.on_message(filters.command("addchat") & filters.user(ADMIN_ID) & (filters.group | filters.channel))
+@drained_command
 async def add_chat(client: Client, message: Message):
     logger.info(f"Received /addchat command from {message.from_user.id} in chat {message.chat.id}")
     chat = message.chat
@@ -413,7 +926,7 @@ async def add_chat(client: Client, message: Message):
             return
         
         if chat_type in ["group", "supergroup", "channel"]:
-            if mongo_db.save_chat(chat_id, chat_type, chat_title):
+            if mongo_db.save_chat(chat_id, chat_type, chat_title, privileges):
                 await message.reply(f"Successfully saved {chat_title} (ID: {chat_id}) to database")
                 logger.info(f"Saved chat {chat_id} ({chat_title}, type: {chat_type}) to database")
             else:
@@ -432,17 +945,25 @@ async def add_chat(client: Client, message: Message):
 
 # Command to clean invalid chats from the database
 @app.on_message(filters.command("cleandb") & filters.user(ADMIN_ID))
+@drained_command
 async def clean_db(client: Client, message: Message):
     logger.info(f"Received /cleandb command from {message.from_user.id}")
     try:
-        chats = mongo_db.get_all_chats()
+        chats = list(mongo_db.chats)
         if not chats:
             await message.reply("No chats found in the database.")
             return
         
         deleted_count = 0
-        for chat in chats:
-            chat_id = chat["chat_id"]
+        for checked, chat in enumerate(chats):
+            if shutdown_started.is_set():
+                await message.reply(
+                    f"Database cleanup stopped for shutdown after {checked} of {len(chats)} chats. "
+                    f"Removed {deleted_count} invalid chats."
+                )
+                logger.info(f"Stopped /cleandb for shutdown after {checked} of {len(chats)} chats")
+                return
+            chat_id = chat.chat_id
             if not await is_chat_valid(client, chat_id):
                 if mongo_db.delete_chat(chat_id):
                     deleted_count += 1
@@ -456,6 +977,7 @@ async def clean_db(client: Client, message: Message):
         logger.error(f"Unexpected error in /cleandb: {str(e)}")
 
 # Command to promote a bot to admin in a specific chat with same permissions
+@timed
 async def promote_with_timeout(client: Client, chat_id: int, user_id: int, bot_username: str, timeout: int = 60):
     """Wait for user to join and promote, with timeout."""
     start_time = datetime.utcnow()
@@ -466,38 +988,39 @@ async def promote_with_timeout(client: Client, chat_id: int, user_id: int, bot_u
                 privileges = await is_bot_admin(client, chat_id)
                 if not privileges:
                     logger.warning(f"Cannot promote user {user_id} in chat {chat_id}: Bot lacks admin permissions")
-                    await client.send_message(
-                        ADMIN_ID,
+                    await notifier.notify(
+                        "Missing permissions",
                         f"Cannot promote @{bot_username} in chat {chat_id}: I lack admin permissions."
                     )
                     return False
-                await client.promote_chat_member(
-                    chat_id=chat_id,
-                    user_id=user_id,
-                    privileges=ChatPrivileges(**privileges)
+                await call_rpc(
+                    client,
+                    lambda: client.promote_chat_member(chat_id, user_id, to_chat_privileges(privileges)),
+                    f"Promotion of user {user_id} in chat {chat_id}", chat_id, user_id=user_id
                 )
                 logger.info(f"Promoted @{bot_username} in chat {chat_id} after joining")
-                await client.send_message(
-                    ADMIN_ID,
+                await notifier.notify(
+                    "Promotions",
                     f"Successfully promoted @{bot_username} to admin in chat {chat_id} after joining"
                 )
                 return True
             except Exception as e:
                 logger.error(f"Failed to promote user {user_id} in chat {chat_id}: {str(e)}")
-                await client.send_message(
-                    ADMIN_ID,
+                await notifier.notify(
+                    "Failed promotions",
                     f"Failed to promote @{bot_username} in chat {chat_id}: {str(e)}"
                 )
                 return False
         await asyncio.sleep(5)  # Check every 5 seconds
     logger.warning(f"Timeout waiting for user {user_id} to join chat {chat_id}")
-    await client.send_message(
-        ADMIN_ID,
+    await notifier.notify(
+        "Join timeouts",
         f"Timeout: @{bot_username} did not join chat {chat_id} within 1 minute. Please add them manually or retry."
     )
     return False
 
 @app.on_message(filters.command("promote") & filters.user(ADMIN_ID))
+@drained_command
 async def promote_bot(client: Client, message: Message):
     logger.info(f"Received /promote command from {message.from_user.id}")
     args = message.text.split()
@@ -517,342 +1040,241 @@ async def promote_bot(client: Client, message: Message):
     
     try:
         # Get target bot
-        bot_member = await client.get_users(bot_username)
+        bot_id = await resolve_user_id(client, bot_username)
         if not await is_chat_valid(client, chat_id):
             await message.reply(f"Chat {chat_id} is invalid or inaccessible. Please verify the chat exists and I'm a member.")
             logger.warning(f"Invalid chat {chat_id} for /promote")
             return
         
+        # Check admin status with fresh data
+        privileges = await is_bot_admin(client, chat_id)
+        if not privileges:
+            await message.reply(
+                "I am not an admin or lack required permissions in this chat. "
+                "Please ensure I have 'Invite Users via Link', 'Ban Members', and 'Add New Admins' permissions in chat settings > Administrators. "
+                "If the issue persists, try granting full admin rights."
+            )
+            logger.warning(f"Bot is not an admin or lacks permissions in chat {chat_id} for /promote")
+            return
+        
+        outcome, detail = await promote_in_chat(client, chat_id, bot_id, bot_username, privileges)
+        if outcome == "success":
+            await message.reply(f"Successfully promoted @{bot_username} to admin in chat {chat_id} with same permissions")
+        else:
+            await message.reply(f"Chat {chat_id}: {detail}")
+        
+    except RPC_EXCEPTIONS as e:
+        await message.reply(f"Error: {str(e)}")
+        logger.error(f"Failed to promote @{bot_username} in {chat_id}: {str(e)}")
+    except Exception as e:
+        await message.reply("An unexpected error occurred. Check logs for details.")
+        logger.error(f"Unexpected error in /promote: {str(e)}")
+
+# Helper function to invite and promote one bot in a chat where the bot's own privileges were verified
+@timed
+async def promote_in_chat(client: Client, chat_id: int, bot_id: int, bot_username: str, privileges: int) -> tuple:
+    """Return (outcome, detail) where outcome is "success", "pending" or "failure"."""
+    try:
         # Check target bot status
-        status = await get_user_status(client, chat_id, bot_member.id)
+        status = await get_user_status(client, chat_id, bot_id)
         if status == "banned":
             # Try unbanning
-            if await unban_user(client, chat_id, bot_member.id):
+            if await unban_user(client, chat_id, bot_id):
                 logger.info(f"Unbanned @{bot_username} in chat {chat_id}")
                 await asyncio.sleep(2)
             else:
-                await message.reply(
-                    f"@{bot_username} is banned from chat {chat_id}, and I couldn't unban them. "
-                    "Please unban them manually in chat settings > Banned Users."
-                )
                 logger.error(f"Failed to unban @{bot_username} in chat {chat_id}")
-                return
-            # Try inviting after unban
-            if await invite_user(client, chat_id, bot_member.id):
-                await asyncio.sleep(2)
-                logger.info(f"Invited @{bot_username} to chat {chat_id} after unban")
-            else:
-                # If invite failed, rely on cache and timeout
-                if chat_id in invite_cache and bot_member.id in invite_cache[chat_id]:
-                    task = asyncio.create_task(
-                        promote_with_timeout(client, chat_id, bot_member.id, bot_username)
-                    )
-                    invite_cache[chat_id][bot_member.id]["task"] = task
-                    await message.reply(
-                        f"Sent invite link to @{bot_username} for chat {chat_id}. "
-                        "Waiting for them to join within 1 minute to promote."
-                    )
-                    return
-                await message.reply(
-                    f"Failed to invite @{bot_username} to chat {chat_id} after unbanning. "
-                    "Please add them manually or ensure I have 'Invite Users via Link' permission."
+                return "failure", (
+                    f"@{bot_username} is banned and couldn't be unbanned. "
+                    "Please unban them manually in chat settings > Banned Users."
                 )
-                logger.error(f"Failed to invite @{bot_username} to chat {chat_id} after unban")
-                return
-        elif not status:
+        if status == "banned" or not status:
             # Try inviting the bot
-            if await invite_user(client, chat_id, bot_member.id):
+            if await invite_user(client, chat_id, bot_id):
                 await asyncio.sleep(2)
                 logger.info(f"Invited @{bot_username} to chat {chat_id}")
-            else:
+            elif chat_id in invite_cache and bot_id in invite_cache[chat_id]:
                 # If invite failed, rely on cache and timeout
-                if chat_id in invite_cache and bot_member.id in invite_cache[chat_id]:
-                    task = asyncio.create_task(
-                        promote_with_timeout(client, chat_id, bot_member.id, bot_username)
-                    )
-                    invite_cache[chat_id][bot_member.id]["task"] = task
-                    await message.reply(
-                        f"Sent invite link to @{bot_username} for chat {chat_id}. "
-                        "Waiting for them to join within 1 minute to promote."
-                    )
-                    return
-                await message.reply(
-                    f"Failed to invite @{bot_username} to chat {chat_id}. "
-                    "Please add them manually or ensure I have 'Invite Users via Link' permission."
+                task = start_promotion_task(client, chat_id, bot_id, bot_username)
+                invite_cache[chat_id][bot_id]["task"] = task
+                return "pending", (
+                    f"Sent invite link to @{bot_username}. "
+                    "Waiting for them to join within 1 minute to promote."
                 )
+            else:
                 logger.error(f"Failed to invite @{bot_username} to chat {chat_id}")
-                return
-        
-        # Check admin status with fresh data
-        privileges = await is_bot_admin(client, chat_id)
-        if not privileges:
-            await message.reply(
-                "I am not an admin or lack required permissions in this chat. "
-                "Please ensure I have 'Invite Users via Link', 'Ban Members', and 'Add New Admins' permissions in chat settings > Administrators. "
-                "If the issue persists, try granting full admin rights."
-            )
-            logger.warning(f"Bot is not an admin or lacks permissions in chat {chat_id} for /promote")
-            return
-        
+                return "failure", (
+                    f"Failed to invite @{bot_username}{' after unbanning' if status == 'banned' else ''}. "
+                    "Please add them manually or ensure I have 'Invite Users via Link' permission."
+                )
+
         # Attempt promotion with retry
         for attempt in range(2):
             try:
-                await client.promote_chat_member(
-                    chat_id=chat_id,
-                    user_id=bot_member.id,
-                    privileges=ChatPrivileges(**privileges)
+                await call_rpc(
+                    client,
+                    lambda: client.promote_chat_member(chat_id, bot_id, to_chat_privileges(privileges)),
+                    f"Promotion of @{bot_username} in chat {chat_id}", chat_id, user_id=bot_id
                 )
-                await message.reply(f"Successfully promoted @{bot_username} to admin in chat {chat_id} with same permissions")
                 logger.info(f"Promoted @{bot_username} in chat {chat_id} with same permissions")
-                return
+                return "success", None
             except RPCError as e:
-                error_msg = str(e)
-                if "CHAT_ADMIN_INVITE_REQUIRED" in error_msg and attempt == 0:
-                    logger.warning(f"Promotion failed in {chat_id}: CHAT_ADMIN_INVITE_REQUIRED, retrying after refresh")
+                if classify(e) == PERMANENT_PERMISSION and attempt == 0:
+                    logger.warning(f"Promotion failed in {chat_id}: {str(e)}, retrying after refresh")
                     await asyncio.sleep(2)
                     privileges = await is_bot_admin(client, chat_id)
                     if not privileges:
                         break
                 else:
                     raise
-        await message.reply(
-            "Failed to promote: I need the 'Invite Users via Link' permission. "
-            "Please go to chat settings > Administrators > Edit my permissions and enable 'Invite Users via Link', 'Ban Members', and 'Add New Admins'. "
-            "If this persists, grant full admin rights to the bot."
-        )
         logger.error(f"Promotion failed in {chat_id}: Missing required permissions")
-        
-    except RPCError as e:
+        return "failure", (
+            "Missing 'Invite Users via Link' permission. "
+            "Enable it in chat settings > Administrators or grant full admin rights."
+        )
+
+    except RPC_EXCEPTIONS as e:
         error_msg = str(e)
-        if "PEER_ID_INVALID" in error_msg:
-            await message.reply(
-                f"Chat {chat_id} is invalid or inaccessible. "
-                "Please verify the chat exists, I'm a member, and the ID is correct (e.g., -100123456789)."
-            )
+        error_class = classify(e)
+        if error_class == PERMANENT_CHAT:
             logger.error(f"Promotion failed: Invalid chat {chat_id}")
-        elif "CHAT_ADMIN_INVITE_REQUIRED" in error_msg:
-            await message.reply(
-                "Failed to promote: I need the 'Invite Users via Link' permission. "
-                "Please go to chat settings > Administrators > Edit my permissions and enable 'Invite Users via Link', 'Ban Members', and 'Add New Admins'. "
-                "If this persists, grant full admin rights to the bot."
+            return "failure", (
+                "Chat is invalid or inaccessible. "
+                "Verify the chat exists and I'm a member, or use /cleandb to remove it."
             )
+        if error_class == PERMANENT_PERMISSION:
             logger.error(f"Promotion failed in {chat_id}: Missing 'Invite Users' permission")
-        elif "USER_NOT_PARTICIPANT" in error_msg:
+            return "failure", (
+                "Missing 'Invite Users via Link' permission. "
+                "Enable it in chat settings > Administrators or grant full admin rights."
+            )
+        if error_class == NEEDS_INVITE:
             # Try inviting again
-            if await invite_user(client, chat_id, bot_member.id):
-                await message.reply(f"Invited @{bot_username} to chat {chat_id}. Please retry the promotion.")
+            if await invite_user(client, chat_id, bot_id):
                 logger.info(f"Invited @{bot_username} to chat {chat_id} after USER_NOT_PARTICIPANT")
-            else:
-                # If invite failed, rely on cache and timeout
-                if chat_id in invite_cache and bot_member.id in invite_cache[chat_id]:
-                    task = asyncio.create_task(
-                        promote_with_timeout(client, chat_id, bot_member.id, bot_username)
-                    )
-                    invite_cache[chat_id][bot_member.id]["task"] = task
-                    await message.reply(
-                        f"Sent invite link to @{bot_username} for chat {chat_id}. "
-                        "Waiting for them to join within 1 minute to promote."
-                    )
-                    return
-                await message.reply(
-                    f"@{bot_username} is not a member of chat {chat_id}, and I couldn't invite them. "
-                    "Please add them manually or check my permissions."
+                return "failure", f"Invited @{bot_username}, please retry."
+            if chat_id in invite_cache and bot_id in invite_cache[chat_id]:
+                task = start_promotion_task(client, chat_id, bot_id, bot_username)
+                invite_cache[chat_id][bot_id]["task"] = task
+                return "pending", (
+                    f"Sent invite link to @{bot_username}. "
+                    "Waiting for them to join within 1 minute to promote."
                 )
-                logger.error(f"Failed to invite @{bot_username} to chat {chat_id}")
-        else:
-            await message.reply(f"Error: {error_msg}")
-            logger.error(f"Failed to promote @{bot_username} in {chat_id}: {error_msg}")
+            logger.error(f"Failed to invite @{bot_username} to chat {chat_id}")
+            return "failure", f"@{bot_username} not a member and couldn't be invited. Please add them manually."
+        logger.error(f"Failed to promote @{bot_username} in {chat_id}: {error_msg}")
+        return "failure", f"@{bot_username}: {error_msg}"
     except Exception as e:
-        await message.reply("An unexpected error occurred. Check logs for details.")
-        logger.error(f"Unexpected error in /promote: {str(e)}")
+        logger.error(f"Unexpected error promoting @{bot_username} in {chat_id}: {str(e)}")
+        return "failure", f"@{bot_username}: Unexpected error"
 
-# Command to promote a bot to admin in all stored chats with same permissions
+# Command to promote one or more bots to admin in all stored chats with same permissions
 @app.on_message(filters.command("promoteall") & filters.user(ADMIN_ID))
+@drained_command
 async def promote_bot_all(client: Client, message: Message):
     logger.info(f"Received /promoteall command from {message.from_user.id}")
     args = message.text.split()
+    mode = args.pop(1) if len(args) > 1 and args[1] in ["--plan", "--execute"] else None
     
-    if len(args) != 2:
-        await message.reply("Usage: /promoteall <bot_username> (e.g., /promoteall @BotUsername)")
+    if len(args) < 2:
+        await message.reply(
+            "Usage: /promoteall [--plan] <bot_username> [bot_username ...] (e.g., /promoteall @BotUsername @OtherBot)\n"
+            "or: /promoteall --execute <plan_id>"
+        )
         logger.warning("Invalid /promoteall command format")
         return
     
-    bot_username = args[1].lstrip("@")
-    success_count = 0
-    failure_count = 0
-    errors = []
-    
     try:
-        bot_member = await client.get_users(bot_username)
-        chats = mongo_db.get_all_chats()
+        plan = None
+        if mode == "--execute":
+            plan = promotion_plans.pop(args[1], None)
+            if not plan or (datetime.utcnow() - plan["created_at"]).total_seconds() > PLAN_TTL:
+                await message.reply(f"Plan {args[1]} not found or expired. Create a new one with /promoteall --plan.")
+                logger.warning(f"Unknown or expired plan {args[1]} for /promoteall --execute")
+                return
+            targets = plan["targets"]
+            chats = [mongo_db.chats.get(chat_id) for chat_id in plan["chats"] if chat_id in mongo_db.chats]
+        else:
+            targets = []
+            for bot_username in dict.fromkeys(arg.lstrip("@") for arg in args[1:]):
+                try:
+                    targets.append((await resolve_user_id(client, bot_username), bot_username))
+                except RPCError as e:
+                    await message.reply(f"Couldn't find @{bot_username}: {str(e)}")
+                    logger.error(f"Failed to resolve @{bot_username} for /promoteall: {str(e)}")
+                    return
+            if mode == "--plan":
+                # Evaluate cached state only; no chat RPCs are spent here
+                plan = build_plan(mongo_db.chats, targets, rate_limiter.observed_rate(), rate_limiter.flood_remaining())
+                # Random IDs, so plans made within the same second don't overwrite each other
+                plan_id = secrets.token_hex(3)
+                while plan_id in promotion_plans:
+                    plan_id = secrets.token_hex(3)
+                promotion_plans[plan_id] = plan
+                await message.reply(
+                    format_plan(plan) + f"\n\nRun /promoteall --execute {plan_id} within {PLAN_TTL // 60} minutes to apply it."
+                )
+                logger.info(f"Created promotion plan {plan_id}: {dict(plan['counts'])}, ~{plan['rpcs']} RPCs")
+                return
+            chats = list(mongo_db.chats)
         if not chats:
             await message.reply("No chats found in the database. Use /addchat in a group or channel to add chats.")
             logger.warning("No chats found in MongoDB")
             return
         
-        for chat in chats:
-            chat_id = chat["chat_id"]
-            chat_title = chat.get("chat_title", str(chat_id))
-            try:
-                # Validate chat
+        results = {bot_username: {"success": 0, "pending": 0, "failure": 0} for _, bot_username in targets}
+        errors = []
+        for checked, chat in enumerate(chats):
+            if shutdown_started.is_set():
+                errors.insert(0, f"Stopped for shutdown after {checked} of {len(chats)} chats; rerun to finish.")
+                logger.info(f"Stopped /promoteall for shutdown after {checked} of {len(chats)} chats")
+                break
+            chat_id = chat.chat_id
+            chat_title = chat.title or str(chat_id)
+            entry = plan["chats"].get(chat_id) if plan else None
+            verdict = entry["verdict"] if entry else "unknown"
+            reason = None
+            if circuit_open(chat_id):
+                reason = "Skipped, chat failed validation repeatedly. Use /cleandb to remove it."
+            elif verdict == "no_permission":
+                reason = "Skipped, missing 'Add New Admins' permission at last check."
+            elif verdict in ["unknown", "dead"]:
+                # Validate the chat and our own privileges once for every requested bot;
+                # planned promotable chats reuse the cached privileges instead
                 if not await is_chat_valid(client, chat_id):
-                    failure_count += 1
-                    errors.append(
-                        f"{chat_title} (ID: {chat_id}): Chat is invalid or inaccessible. "
+                    reason = (
+                        "Chat is invalid or inaccessible. "
                         "Verify the chat exists and I'm a member, or use /cleandb to remove it."
                     )
                     logger.warning(f"Invalid chat {chat_id} for promotion")
-                    continue
-                
-                # Check target bot status
-                status = await get_user_status(client, chat_id, bot_member.id)
-                if status == "banned":
-                    # Try unbanning
-                    if await unban_user(client, chat_id, bot_member.id):
-                        logger.info(f"Unbanned @{bot_username} in chat {chat_id}")
-                        await asyncio.sleep(2)
-                    else:
-                        failure_count += 1
-                        errors.append(
-                            f"{chat_title} (ID: {chat_id}): @{bot_username} is banned and couldn't be unbanned. "
-                            "Please unban them manually in chat settings > Banned Users."
-                        )
-                        logger.error(f"Failed to unban @{bot_username} in chat {chat_id}")
-                        continue
-                    # Try inviting after unban
-                    if await invite_user(client, chat_id, bot_member.id):
-                        await asyncio.sleep(2)
-                        logger.info(f"Invited @{bot_username} to chat {chat_id} after unban")
-                    else:
-                        # If invite failed, rely on cache and timeout
-                        if chat_id in invite_cache and bot_member.id in invite_cache[chat_id]:
-                            task = asyncio.create_task(
-                                promote_with_timeout(client, chat_id, bot_member.id, bot_username)
-                            )
-                            invite_cache[chat_id][bot_member.id]["task"] = task
-                            errors.append(
-                                f"{chat_title} (ID: {chat_id}): Sent invite link to @{bot_username}. "
-                                "Waiting for them to join within 1 minute to promote."
-                            )
-                            continue
-                        failure_count += 1
-                        errors.append(
-                            f"{chat_title} (ID: {chat_id}): Failed to invite @{bot_username} after unbanning. "
-                            "Please add them manually or ensure I have 'Invite Users via Link' permission."
-                        )
-                        logger.error(f"Failed to invite @{bot_username} to chat {chat_id} after unban")
-                        continue
-                elif not status:
-                    # Try inviting the bot
-                    if await invite_user(client, chat_id, bot_member.id):
-                        await asyncio.sleep(2)
-                        logger.info(f"Invited @{bot_username} to chat {chat_id}")
-                    else:
-                        # If invite failed, rely on cache and timeout
-                        if chat_id in invite_cache and bot_member.id in invite_cache[chat_id]:
-                            task = asyncio.create_task(
-                                promote_with_timeout(client, chat_id, bot_member.id, bot_username)
-                            )
-                            invite_cache[chat_id][bot_member.id]["task"] = task
-                            errors.append(
-                                f"{chat_title} (ID: {chat_id}): Sent invite link to @{bot_username}. "
-                                "Waiting for them to join within 1 minute to promote."
-                            )
-                            continue
-                        failure_count += 1
-                        errors.append(
-                            f"{chat_title} (ID: {chat_id}): Failed to invite @{bot_username}. "
-                            "Please add them manually or ensure I have 'Invite Users via Link' permission."
-                        )
-                        logger.error(f"Failed to invite @{bot_username} to chat {chat_id}")
-                        continue
-                
-                # Check admin status with fresh data
-                privileges = await is_bot_admin(client, chat_id)
-                if not privileges:
-                    failure_count += 1
-                    errors.append(
-                        f"{chat_title} (ID: {chat_id}): Missing 'Invite Users via Link', 'Ban Members', or 'Add New Admins' permissions. "
+                elif not await is_bot_admin(client, chat_id):
+                    reason = (
+                        "Missing 'Invite Users via Link', 'Ban Members', or 'Add New Admins' permissions. "
                         "Try granting full admin rights."
                     )
                     logger.warning(f"Bot lacks permissions in chat {chat_id}")
-                    continue
-                
-                # Attempt promotion with retry
-                for attempt in range(2):
-                    try:
-                        await client.promote_chat_member(
-                            chat_id=chat_id,
-                            user_id=bot_member.id,
-                            privileges=ChatPrivileges(**privileges)
-                        )
-                        success_count += 1
-                        logger.info(f"Promoted @{bot_username} in chat {chat_id} ({chat_title}) with same permissions")
-                        break
-                    except RPCError as e:
-                        error_msg = str(e)
-                        if "CHAT_ADMIN_INVITE_REQUIRED" in error_msg and attempt == 0:
-                            logger.warning(f"Promotion failed in {chat_id}: CHAT_ADMIN_INVITE_REQUIRED, retrying after refresh")
-                            await asyncio.sleep(2)
-                            privileges = await is_bot_admin(client, chat_id)
-                            if not privileges:
-                                break
-                        else:
-                            raise
-                else:
-                    failure_count += 1
-                    errors.append(
-                        f"{chat_title} (ID: {chat_id}): Missing 'Invite Users via Link' permission. "
-                        "Enable it in chat settings > Administrators or grant full admin rights."
-                    )
-                    logger.error(f"Promotion failed in {chat_id}: Missing required permissions")
+            if reason:
+                for _, bot_username in targets:
+                    results[bot_username]["failure"] += 1
+                errors.append(f"{chat_title} (ID: {chat_id}): {reason}")
+                continue
             
-            except RPCError as e:
-                failure_count += 1
-                error_msg = str(e)
-                if "PEER_ID_INVALID" in error_msg:
-                    errors.append(
-                        f"{chat_title} (ID: {chat_id}): Chat is invalid or inaccessible. "
-                        "Verify the chat exists and I'm a member, or use /cleandb to remove it."
-                    )
-                    logger.error(f"Promotion failed: Invalid chat {chat_id}")
-                elif "CHAT_ADMIN_INVITE_REQUIRED" in error_msg:
-                    errors.append(
-                        f"{chat_title} (ID: {chat_id}): Missing 'Invite Users via Link' permission. "
-                        "Enable it in chat settings > Administrators or grant full admin rights."
-                    )
-                    logger.error(f"Promotion failed in {chat_id}: Missing 'Invite Users' permission")
-                elif "USER_NOT_PARTICIPANT" in error_msg:
-                    # Try inviting again
-                    if await invite_user(client, chat_id, bot_member.id):
-                        errors.append(f"{chat_title} (ID: {chat_id}): Invited @{bot_username}, please retry.")
-                        logger.info(f"Invited @{bot_username} to chat {chat_id} after USER_NOT_PARTICIPANT")
-                    else:
-                        # If invite failed, rely on cache and timeout
-                        if chat_id in invite_cache and bot_member.id in invite_cache[chat_id]:
-                            task = asyncio.create_task(
-                                promote_with_timeout(client, chat_id, bot_member.id, bot_username)
-                            )
-                            invite_cache[chat_id][bot_member.id]["task"] = task
-                            errors.append(
-                                f"{chat_title} (ID: {chat_id}): Sent invite link to @{bot_username}. "
-                                "Waiting for them to join within 1 minute to promote."
-                            )
-                            continue
-                        errors.append(
-                            f"{chat_title} (ID: {chat_id}): @{bot_username} not a member and couldn't be invited. "
-                            "Please add them manually."
-                        )
-                        logger.error(f"Failed to invite @{bot_username} to chat {chat_id}")
+            for bot_id, bot_username in targets:
+                # A failed refresh during an earlier bot's promotion clears the chat's privileges
+                if chat.privileges:
+                    outcome, detail = await promote_in_chat(client, chat_id, bot_id, bot_username, chat.privileges)
                 else:
-                    errors.append(f"{chat_title} (ID: {chat_id}): {error_msg}")
-                    logger.error(f"Failed to promote @{bot_username} in {chat_id}: {error_msg}")
-            except Exception as e:
-                failure_count += 1
-                errors.append(f"{chat_title} (ID: {chat_id}): Unexpected error")
-                logger.error(f"Unexpected error promoting @{bot_username} in {chat_id}: {str(e)}")
+                    outcome, detail = "failure", f"Lost admin permissions before @{bot_username} could be promoted."
+                results[bot_username][outcome] += 1
+                if detail:
+                    errors.append(f"{chat_title} (ID: {chat_id}): {detail}")
         
-        reply = f"Promotion complete!\nSuccessfully promoted @{bot_username} in {success_count} chats.\nFailed in {failure_count} chats."
+        reply = "Promotion complete!"
+        for bot_username, counts in results.items():
+            reply += (
+                f"\n@{bot_username}: promoted in {counts['success']} chats, failed in {counts['failure']} chats"
+                + (f", waiting on {counts['pending']} invite links." if counts["pending"] else ".")
+            )
         if errors:
             reply += "\n\nErrors:\n" + "\n".join([f"- {e}" for e in errors[:5]])
             if len(errors) > 5:
@@ -871,24 +1293,68 @@ async def start(client: Client, message: Message):
         "Commands:\n"
         "/addchat - Add the current chat to the database (use in group/channel)\n"
         "/promote <bot_username> <chat_id> - Invite and promote a bot in a specific chat\n"
-        "/promoteall <bot_username> - Invite and promote a bot in all stored chats\n"
+        "/promoteall <bot_username> [bot_username ...] - Invite and promote bots in all stored chats\n"
+        "/promoteall --plan <bot_username> [...] - Estimate a /promoteall run from cached state, then --execute <plan_id>\n"
         "/cleandb - Remove invalid chats from the database\n"
-        "/init - Start periodic admin status checks"
+        "/profile <seconds> - Capture a sampling profile and send it as a file\n"
+        "/init - Restart periodic admin status checks if they stopped"
     )
     logger.info(f"Start command received from {message.from_user.id}")
 
-# Initialize periodic task after startup
+# Command to capture a sampling profile of the running bot
+@app.on_message(filters.command("profile") & filters.user(ADMIN_ID))
+@drained_command
+async def profile(client: Client, message: Message):
+    logger.info(f"Received /profile command from {message.from_user.id}")
+    args = message.text.split()
+    try:
+        seconds = float(args[1]) if len(args) > 1 else 10.0
+    except ValueError:
+        seconds = None
+    # The negated check also rejects NaN
+    if seconds is None or not 0 < seconds <= MAX_PROFILE_SECONDS:
+        await message.reply(f"Usage: /profile <seconds> (e.g., /profile 30), at most {MAX_PROFILE_SECONDS}s")
+        return
+    try:
+        await message.reply(f"Profiling for {seconds:g}s...")
+        # Sample the event loop thread from a worker thread so the loop keeps running normally
+        samples = await asyncio.to_thread(sample_thread, threading.get_ident(), seconds)
+        report = io.BytesIO(format_report(samples, seconds).encode())
+        report.name = f"profile_{datetime.utcnow():%Y%m%d_%H%M%S}.txt"
+        await message.reply_document(report, caption=f"Sampling profile ({sum(samples.values())} samples)")
+        logger.info(f"Sent {seconds:g}s sampling profile")
+    except Exception as e:
+        await message.reply(f"Failed to profile: {str(e)}")
+        logger.error(f"Failed to capture profile: {str(e)}")
+
+# Restart the periodic task if it stopped (it starts automatically on boot)
 @app.on_message(filters.command("init") & filters.user(ADMIN_ID))
 async def init(client: Client, message: Message):
     try:
-        asyncio.create_task(check_all_chats_admin_status(client))
-        await message.reply("Initialized periodic admin status check.")
-        logger.info("Initialized periodic admin status check")
+        if start_sweep(client):
+            await message.reply("Initialized periodic admin status check.")
+            logger.info("Initialized periodic admin status check")
+        else:
+            await message.reply("Periodic admin status check is already running.")
     except Exception as e:
         await message.reply(f"Failed to initialize: {str(e)}")
         logger.error(f"Failed to initialize periodic check: {str(e)}")
 
+async def main():
+    # Restore FloodWait deadlines first: app.start() already sends RPCs through PromoterClient.invoke
+    await asyncio.to_thread(mongo_db.connect)
+    await warm_rate_limiter()
+    await app.start()
+    try:
+        await startup(app)
+        await idle()
+    finally:
+        await shutdown(app)
+        # A failed restart_client() may have left the client stopped already
+        if app.is_connected:
+            await app.stop()
+
 # Run the bot
 if __name__ == "__main__":
     logger.info("Starting Admin Promoter Bot")
-    app.run()
+    app.run(main())
@@ -1,7 +1,13 @@
 # companion_bot.py
 import logging
-from pyrogram import Client, filters
+import asyncio
+import re
+import time
+from pyrogram import Client, filters, idle
+from pyrogram.types import Message
+from pyrogram.errors import RPCError, FloodWait
 from config import API_ID, API_HASH, ADMIN_ID
+from ratelimit import RateLimiter
 
 # Set up logging
 logging.basicConfig(
@@ -19,22 +25,86 @@ app = Client(
     bot_token="your_akash52131_bot_token_here"  # Replace with @Akash52131_bot's token
 )
 
+INVITE_LINK_PATTERN = re.compile(r"(?:https?://)?t\.me/(?:\+|joinchat/)[\w-]+")
+INVITE_LINK_TTL = 60  # Seconds an invite link from the promoter bot stays valid
+JOIN_WORKERS = 3  # Concurrent join attempts
+JOIN_INTERVAL = 1.0  # Minimum seconds between join attempts across all workers
+REPORT_INTERVAL = 10  # Seconds to collect join results before reporting them
+JOIN_METHOD = "join_chat"
+
+# Invite links ordered by expiry so the most urgent are joined first
+join_queue = asyncio.PriorityQueue()  # (expires_at, invite_link)
+seen_links = {}  # {invite_link: expires_at} for links already queued, so duplicates are joined once
+join_results = []  # [(invite_link, error or None)] waiting for the next report
+pacer = RateLimiter(min_interval=JOIN_INTERVAL)
+
 # Handler for receiving invite links
 @app.on_message(filters.user(ADMIN_ID) & filters.text & filters.private)
 async def handle_invite_link(client: Client, message: Message):
-    text = message.text
-    if "t.me/+" in text:
+    sent_at = message.date.timestamp() if message.date else time.time()
+    # Expired links can't be joined again anyway, so stop remembering them
+    now = time.time()
+    for link in [link for link, expires_at in seen_links.items() if expires_at < now]:
+        del seen_links[link]
+    queued = 0
+    for invite_link in INVITE_LINK_PATTERN.findall(message.text):
+        if invite_link in seen_links:
+            continue
+        seen_links[invite_link] = sent_at + INVITE_LINK_TTL
+        await join_queue.put((sent_at + INVITE_LINK_TTL, invite_link))
+        queued += 1
+    if queued:
+        logger.info(f"Queued {queued} invite links ({join_queue.qsize()} waiting)")
+
+# Worker that joins queued chats under the shared pacer
+async def join_worker(client: Client):
+    while True:
+        expires_at, invite_link = await join_queue.get()
         try:
-            # Extract invite link
-            invite_link = next((word for word in text.split() if "t.me/+" in word), None)
-            if invite_link:
-                # Join the chat
-                await client.join_chat(invite_link)
-                logger.info(f"Joined chat via invite link: {invite_link}")
-                await message.reply("Joined the chat successfully!")
-        except Exception as e:
+            if time.time() > expires_at:
+                join_results.append((invite_link, "Link expired before it could be used"))
+                logger.warning(f"Invite link expired before joining: {invite_link}")
+                continue
+            await pacer.acquire(JOIN_METHOD)
+            # The wait for a pacing slot or a FloodWait can outlast the link
+            if time.time() > expires_at:
+                join_results.append((invite_link, "Link expired while waiting to join"))
+                logger.warning(f"Invite link expired while waiting to join: {invite_link}")
+                continue
+            await client.join_chat(invite_link)
+            join_results.append((invite_link, None))
+            logger.info(f"Joined chat via invite link: {invite_link}")
+        except FloodWait as e:
+            pacer.record_flood(JOIN_METHOD, e.value)
+            logger.warning(f"Flood wait {e.value}s joining via {invite_link}, requeueing")
+            await join_queue.put((expires_at, invite_link))
+        except RPCError as e:
+            join_results.append((invite_link, str(e)))
             logger.error(f"Failed to join chat via invite link {invite_link}: {str(e)}")
-            await message.reply(f"Failed to join chat: {str(e)}")
+        except Exception as e:
+            join_results.append((invite_link, "Unexpected error"))
+            logger.error(f"Unexpected error joining via invite link {invite_link}: {str(e)}")
+        finally:
+            join_queue.task_done()
+
+# Periodic task that reports join results back in one message
+async def report_results(client: Client):
+    while True:
+        await asyncio.sleep(REPORT_INTERVAL)
+        if not join_results:
+            continue
+        results = join_results[:]
+        del join_results[:len(results)]
+        failures = [(link, error) for link, error in results if error]
+        reply = f"Joined {len(results) - len(failures)}/{len(results)} chats from invite links."
+        if failures:
+            reply += "\n\nFailed:\n" + "\n".join([f"- {link}: {error}" for link, error in failures[:10]])
+            if len(failures) > 10:
+                reply += f"\n...and {len(failures) - 10} more (check logs)."
+        try:
+            await client.send_message(ADMIN_ID, reply)
+        except Exception as e:
+            logger.error(f"Failed to report join results: {str(e)}")
 
 # Start command
 @app.on_message(filters.command("start") & filters.user(ADMIN_ID))
@@ -42,7 +112,19 @@ async def start(client: Client, message: Message):
     await message.reply("I'm ready to receive invite links and join chats!")
     logger.info("Companion bot started")
 
+async def main():
+    await app.start()
+    tasks = [asyncio.create_task(join_worker(app)) for _ in range(JOIN_WORKERS)]
+    tasks.append(asyncio.create_task(report_results(app)))
+    try:
+        await idle()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await app.stop()
+
 # Run the bot
 if __name__ == "__main__":
     logger.info("Starting Companion Bot")
-    app.run()
+    app.run(main())
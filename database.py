@@ -1,39 +1,211 @@
 # database.py
-from pymongo import MongoClient
-from pymongo.errors import ConnectionFailure
+from datetime import datetime, timedelta
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import ConnectionFailure, ConfigurationError, OperationFailure, PyMongoError
 from config import MONGO_URI, MONGO_DB_NAME
 import logging
+import threading
+from profiling import timed
+from registry import ChatRegistry
 
 # Set up logging
 logger = logging.getLogger(__name__)
 
+CHANGE_STREAM_UNSUPPORTED = 40573  # Error code for change streams on a standalone server
+# Error codes for a resume token the server can no longer resume from
+RESUME_TOKEN_LOST = [260, 286]  # InvalidResumeToken, ChangeStreamHistoryLost
+WATCHED_COLLECTIONS = ["chats", "pending_invites"]
+PEER_REFRESH_INTERVAL = 3600  # Seconds after which an unchanged peer seen again gets a fresh updated_at
+
 class MongoDB:
     def __init__(self):
-        try:
+        self.client = None
+        self._db = None
+        self.chats = ChatRegistry()  # Compact records of every stored chat
+        self.pending_chats = {}  # {chat_id: {"$set" fields}} waiting for flush_pending()
+        self.peers = {}  # {peer_id: {"peer_id", "access_hash", "peer_type", "username", "updated_at"}}
+        self.usernames = {}  # {username: peer_id}
+        self.pending_peers = {}  # {peer_id: peer document} waiting for flush_pending()
+        self.chat_doc_ids = {}  # {_id: chat_id}, so change-stream deletes can be mapped back to chats
+        self.flush_lock = threading.Lock()  # Serializes flush_pending() calls from different threads
+        # Odd while a flush is writing and bumped by every flush, so delete inference can tell
+        # whether a chat missing from a read was just on its way to the database
+        self.flush_generation = 0
+
+    @property
+    def db(self):
+        # Create the client lazily: resolving a mongodb+srv URI blocks on DNS,
+        # so importing the bot must not do it
+        if self._db is None:
             self.client = MongoClient(MONGO_URI)
-            self.db = self.client[MONGO_DB_NAME]
-            # Test connection
-            self.client.admin.command("ping")
+            self._db = self.client[MONGO_DB_NAME]
+        return self._db
+
+    @timed
+    def connect(self):
+        """Verify the MongoDB connection. Blocking; run it off the event loop."""
+        try:
+            self.db.client.admin.command("ping")
             logger.info("Connected to MongoDB successfully")
-        except ConnectionFailure as e:
+        except (ConnectionFailure, ConfigurationError) as e:
             logger.error(f"Failed to connect to MongoDB: {str(e)}")
             raise
 
-    def save_chat(self, chat_id: int, chat_type: str, chat_title: str):
+    @timed
+    def warm_cache(self):
+        """Load all stored chats into the chat registry."""
+        docs = self.get_all_chats()
+        self.chats.load(docs)
+        self.chat_doc_ids = {doc["_id"]: doc["chat_id"] for doc in docs}
+        return self.chats
+
+    def _chat_fields(self, chat_type: str, chat_title: str, privileges: int = None):
+        fields = {"chat_type": chat_type, "chat_title": chat_title, "updated_at": datetime.utcnow()}
+        if privileges is not None:
+            fields["privileges"] = privileges
+            fields["checked_at"] = datetime.utcnow()
+        return fields
+
+    @timed
+    def save_chat(self, chat_id: int, chat_type: str, chat_title: str, privileges: int = None):
         """Save a chat to the database."""
         try:
             collection = self.db.chats
+            fields = self._chat_fields(chat_type, chat_title, privileges)
             collection.update_one(
                 {"chat_id": chat_id},
-                {"$set": {"chat_type": chat_type, "chat_title": chat_title}},
+                {"$set": fields},
                 upsert=True
             )
+            self.chats.apply(chat_id, fields)
+            self.pending_chats.pop(chat_id, None)
             logger.info(f"Saved chat {chat_id} ({chat_title}, type: {chat_type}) to MongoDB")
             return True
         except Exception as e:
             logger.error(f"Failed to save chat {chat_id}: {str(e)}")
             return False
 
+    def queue_chat(self, chat_id: int, chat_type: str, chat_title: str, privileges: int = None):
+        """Buffer a chat save until the next flush_pending() call."""
+        fields = self._chat_fields(chat_type, chat_title, privileges)
+        self.pending_chats.setdefault(chat_id, {}).update(fields)
+        self.chats.apply(chat_id, fields)
+        return len(self.pending_chats)
+
+    @timed
+    def warm_peers(self):
+        """Load the persisted peer-resolution cache."""
+        try:
+            docs = list(self.db.peers.find({}, {"_id": 0}))
+            self.peers = {doc["peer_id"]: doc for doc in docs}
+            self.usernames = {doc["username"]: doc["peer_id"] for doc in docs if doc.get("username")}
+            logger.info(f"Retrieved {len(docs)} peers from MongoDB")
+            return docs
+        except Exception as e:
+            logger.error(f"Failed to retrieve peers: {str(e)}")
+            return []
+
+    def queue_peers(self, peers):
+        """Buffer changed (peer_id, access_hash, peer_type, username, phone_number) tuples."""
+        now = datetime.utcnow()
+        for peer_id, access_hash, peer_type, username, _ in peers:
+            cached = self.peers.get(peer_id)
+            if cached and cached["access_hash"] == access_hash and cached.get("username") == username:
+                # Seeing an unchanged peer again confirms it; refresh it now and then so a
+                # username lookup doesn't go stale just because nothing changed
+                if (now - cached["updated_at"]).total_seconds() >= PEER_REFRESH_INTERVAL:
+                    cached["updated_at"] = now
+                    self.pending_peers[peer_id] = cached
+                continue
+            doc = {
+                "peer_id": peer_id,
+                "access_hash": access_hash,
+                "peer_type": peer_type,
+                "username": username,
+                "updated_at": now
+            }
+            self.peers[peer_id] = doc
+            if username:
+                self.usernames[username] = peer_id
+            self.pending_peers[peer_id] = doc
+
+    def get_peer_by_username(self, username: str, max_age: float = None):
+        """Look up a cached peer by username, ignoring entries older than max_age seconds."""
+        peer = self.peers.get(self.usernames.get(username.lower()))
+        if peer and peer.get("username") == username.lower():
+            if max_age is None or (datetime.utcnow() - peer["updated_at"]).total_seconds() <= max_age:
+                return peer
+        return None
+
+    def _flush(self, collection, key: str, attr: str):
+        pending = getattr(self, attr)
+        if not pending:
+            return 0
+        setattr(self, attr, {})
+        try:
+            requests = [
+                UpdateOne({key: doc_id}, {"$set": fields}, upsert=True)
+                for doc_id, fields in pending.items()
+            ]
+            collection.bulk_write(requests, ordered=False)
+            logger.info(f"Flushed {len(requests)} pending writes to {collection.name}")
+            return len(requests)
+        except Exception as e:
+            # Keep the writes so the next flush retries them
+            current = getattr(self, attr)
+            for doc_id, fields in pending.items():
+                # Fields queued since the swap are newer than the failed ones
+                current[doc_id] = {**fields, **current.get(doc_id, {})}
+            logger.error(f"Failed to flush {len(pending)} pending writes to {collection.name}: {str(e)}")
+            return 0
+
+    def queue_chat_state(self, chat_id: int, fields: dict):
+        """Buffer cached verification state for a stored chat; unknown chats are ignored."""
+        if chat_id not in self.chats:
+            return False
+        fields = {**fields, "updated_at": datetime.utcnow()}
+        self.chats.apply(chat_id, fields)
+        self.pending_chats.setdefault(chat_id, {}).update(fields)
+        return True
+
+    @timed
+    def flush_pending(self):
+        """Write all buffered chat and peer saves in bulk."""
+        with self.flush_lock:
+            self.flush_generation += 1
+            try:
+                return (
+                    self._flush(self.db.chats, "chat_id", "pending_chats")
+                    + self._flush(self.db.peers, "peer_id", "pending_peers")
+                )
+            finally:
+                self.flush_generation += 1
+
+    def flush_raced(self, generation: int) -> bool:
+        """Whether a flush was running at, or has started since, the given flush_generation."""
+        return generation % 2 == 1 or generation != self.flush_generation
+
+    def missing_chats(self, stored: set, generation: int) -> list:
+        """Chat IDs in the registry that a read started at generation shows as deleted.
+
+        Chats with unflushed local writes are never missing, and nothing is while a flush raced the read.
+        """
+        if self.flush_raced(generation):
+            return []
+        return [
+            record.chat_id for record in self.chats
+            if record.chat_id not in stored and record.chat_id not in self.pending_chats
+        ]
+
+    def resync_chats(self, docs: list, generation: int):
+        """Bring the registry in line with a full read of the chats collection. Call from the event loop thread."""
+        for chat_id in self.missing_chats({doc["chat_id"] for doc in docs}, generation):
+            self.apply_chat_change("delete", {"chat_id": chat_id})
+        for doc in docs:
+            self.apply_chat_change("replace", doc)
+        self.chat_doc_ids = {doc["_id"]: doc["chat_id"] for doc in docs}
+
+    @timed
     def get_all_chats(self):
         """Retrieve all stored chats."""
         try:
@@ -45,11 +217,14 @@ class MongoDB:
             logger.error(f"Failed to retrieve chats: {str(e)}")
             return []
 
+    @timed
     def delete_chat(self, chat_id: int):
         """Delete a chat from the database."""
         try:
             collection = self.db.chats
             result = collection.delete_one({"chat_id": chat_id})
+            self.chats.remove(chat_id)
+            self.pending_chats.pop(chat_id, None)
             if result.deleted_count > 0:
                 logger.info(f"Deleted chat {chat_id} from MongoDB")
                 return True
@@ -59,3 +234,187 @@ class MongoDB:
         except Exception as e:
             logger.error(f"Failed to delete chat {chat_id}: {str(e)}")
             return False
+
+    def get_sweep_checkpoint(self):
+        """Return the saved pagination offset of an unfinished sweep, if any."""
+        try:
+            return self.db.sweep_state.find_one({"_id": "dialogs"}, {"_id": 0})
+        except Exception as e:
+            logger.error(f"Failed to load sweep checkpoint: {str(e)}")
+            return None
+
+    def save_sweep_checkpoint(self, offset: dict):
+        """Save the sweep pagination offset to resume from; None marks the sweep as finished."""
+        try:
+            if offset is None:
+                self.db.sweep_state.delete_one({"_id": "dialogs"})
+            else:
+                self.db.sweep_state.replace_one(
+                    {"_id": "dialogs"},
+                    {**offset, "updated_at": datetime.utcnow()},
+                    upsert=True
+                )
+            return True
+        except Exception as e:
+            logger.error(f"Failed to save sweep checkpoint: {str(e)}")
+            return False
+
+    def get_rate_state(self):
+        """Return the rate limiter snapshot saved by the last run, if any."""
+        try:
+            doc = self.db.rate_state.find_one({"_id": "limiter"})
+        except Exception as e:
+            logger.error(f"Failed to load rate limiter state: {str(e)}")
+            return None
+        if not doc:
+            return None
+        return {
+            "flood_until": {item["method"]: item["until"] for item in doc["flood_until"]},
+            "calls": {item["method"]: item["stamps"] for item in doc["calls"]},
+        }
+
+    def save_rate_state(self, state: dict):
+        """Save a rate limiter snapshot; method names contain dots, so they are stored as values, not keys."""
+        try:
+            self.db.rate_state.replace_one(
+                {"_id": "limiter"},
+                {
+                    "flood_until": [{"method": method, "until": until} for method, until in state["flood_until"].items()],
+                    "calls": [{"method": method, "stamps": stamps} for method, stamps in state["calls"].items()],
+                    "updated_at": datetime.utcnow()
+                },
+                upsert=True
+            )
+            return True
+        except Exception as e:
+            logger.error(f"Failed to save rate limiter state: {str(e)}")
+            return False
+
+    def save_invite(self, chat_id: int, user_id: int, link: str, expires: datetime):
+        """Share a pending invite with other instances."""
+        try:
+            self.db.pending_invites.replace_one(
+                {"_id": f"{chat_id}:{user_id}"},
+                {"chat_id": chat_id, "user_id": user_id, "link": link, "expires": expires},
+                upsert=True
+            )
+            return True
+        except Exception as e:
+            logger.error(f"Failed to save pending invite for user {user_id} in chat {chat_id}: {str(e)}")
+            return False
+
+    def delete_invite(self, chat_id: int, user_id: int):
+        try:
+            self.db.pending_invites.delete_one({"_id": f"{chat_id}:{user_id}"})
+            return True
+        except Exception as e:
+            logger.error(f"Failed to delete pending invite for user {user_id} in chat {chat_id}: {str(e)}")
+            return False
+
+    def get_pending_invites(self):
+        """Retrieve invites that have not expired yet."""
+        try:
+            return list(self.db.pending_invites.find({"expires": {"$gt": datetime.utcnow()}}))
+        except Exception as e:
+            logger.error(f"Failed to retrieve pending invites: {str(e)}")
+            return []
+
+    def apply_chat_change(self, operation: str, document: dict):
+        """Apply a chat change made by any instance to the registry. Call from the event loop thread."""
+        chat_id = document["chat_id"]
+        if operation == "delete":
+            self.chats.remove(chat_id)
+            self.pending_chats.pop(chat_id, None)
+            return
+        self.chats.apply(chat_id, document)
+        if chat_id in self.pending_chats:
+            # Local writes that haven't been flushed yet are newer than the stored document
+            self.chats.apply(chat_id, self.pending_chats[chat_id])
+
+    def _report_change(self, on_change, collection: str, operation: str, doc_id, document: dict):
+        if collection == "chats":
+            if document:
+                self.chat_doc_ids[doc_id] = document["chat_id"]
+            elif operation == "delete" and doc_id in self.chat_doc_ids:
+                document = {"chat_id": self.chat_doc_ids.pop(doc_id)}
+        elif collection == "pending_invites" and operation == "delete":
+            chat_id, user_id = doc_id.split(":")
+            document = {"chat_id": int(chat_id), "user_id": int(user_id)}
+        if document:
+            on_change(collection, operation, document)
+
+    def watch_changes(self, on_change, stop, poll_interval: float = 30, on_resync=None):
+        """Report chat and invite changes from every instance via on_change(collection, operation, document).
+
+        Blocking; run it in its own thread and set stop to end it. Falls back to polling
+        when the server is not a replica set. If the stream can't be resumed, changes may
+        have been missed, so on_resync() is called once a fresh stream is open.
+        """
+        pipeline = [{"$match": {"ns.coll": {"$in": WATCHED_COLLECTIONS}}}]
+        resume_token = None
+        resync = False
+        while not stop.is_set():
+            try:
+                with self.db.watch(
+                    pipeline,
+                    full_document="updateLookup",
+                    resume_after=resume_token,
+                    max_await_time_ms=1000
+                ) as stream:
+                    logger.info("Watching MongoDB change stream for chats and pending invites")
+                    if resync and on_resync:
+                        on_resync()
+                    resync = False
+                    while not stop.is_set():
+                        change = stream.try_next()
+                        resume_token = stream.resume_token
+                        if change is None or change["operationType"] not in ["insert", "update", "replace", "delete"]:
+                            continue
+                        self._report_change(
+                            on_change,
+                            change["ns"]["coll"],
+                            change["operationType"],
+                            change["documentKey"]["_id"],
+                            change.get("fullDocument")
+                        )
+            except OperationFailure as e:
+                if e.code == CHANGE_STREAM_UNSUPPORTED:
+                    logger.warning("MongoDB change streams are unavailable, polling for changes instead")
+                    self.poll_changes(on_change, stop, poll_interval)
+                    return
+                if e.code in RESUME_TOKEN_LOST:
+                    # Retrying with the same token would fail forever; start a fresh stream and reload instead
+                    logger.warning(f"MongoDB change stream can't resume, reloading chats and invites: {str(e)}")
+                    resume_token = None
+                    resync = True
+                    continue
+                logger.error(f"MongoDB change stream failed: {str(e)}")
+                stop.wait(5)
+            except PyMongoError as e:
+                logger.error(f"MongoDB change stream failed: {str(e)}")
+                stop.wait(5)
+
+    def poll_changes(self, on_change, stop, interval: float):
+        """Polling fallback for watch_changes(). Blocking."""
+        since = datetime.utcnow()
+        invite_ids = {doc["_id"] for doc in self.get_pending_invites()}
+        while not stop.wait(interval):
+            try:
+                # Overlap the window a little to tolerate clock skew between instances
+                polled_at = datetime.utcnow()
+                for doc in self.db.chats.find({"updated_at": {"$gte": since - timedelta(seconds=5)}}):
+                    self._report_change(on_change, "chats", "update", doc["_id"], doc)
+                generation = self.flush_generation
+                stored = {doc["chat_id"] for doc in self.db.chats.find({}, {"chat_id": 1})}
+                for chat_id in self.missing_chats(stored, generation):
+                    on_change("chats", "delete", {"chat_id": chat_id})
+                since = polled_at
+
+                invites = {doc["_id"]: doc for doc in self.get_pending_invites()}
+                for doc_id in invite_ids - invites.keys():
+                    self._report_change(on_change, "pending_invites", "delete", doc_id, None)
+                for doc_id in invites.keys() - invite_ids:
+                    on_change("pending_invites", "insert", invites[doc_id])
+                invite_ids = set(invites)
+            except PyMongoError as e:
+                logger.error(f"Failed to poll MongoDB for changes: {str(e)}")
@@ -0,0 +1,112 @@
+# notifier.py
+import asyncio
+import logging
+from pyrogram.errors import FloodWait
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_LENGTH = 4096  # Telegram's limit for a single text message
+SEND_MESSAGE_METHOD = "functions.messages.SendMessage"
+
+class AdminNotifier:
+    """Buffer admin notices by category and send them as digest messages."""
+
+    def __init__(self, chat_id: int, interval: float = 30, max_items: int = 20, rate_limiter=None):
+        self.chat_id = chat_id
+        self.interval = interval  # Seconds between digests
+        self.max_items = max_items  # Buffered notices that trigger an early digest
+        self.rate_limiter = rate_limiter
+        self.buffer = {}  # {category: [text]}
+        self.held = []  # Urgent notices raised before start(), sent individually once it runs
+        self.client = None
+        self.task = None
+        self.flush_requested = asyncio.Event()
+
+    def start(self, client):
+        self.client = client
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task and not self.task.done():
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+        if self.client is None and (self.held or self.buffer):
+            dropped = len(self.held) + sum(len(items) for items in self.buffer.values())
+            logger.warning(f"Dropping {dropped} admin notices, the notifier was never started")
+            return
+        await self._send_held()
+        await self.flush()
+
+    async def notify(self, category: str, text: str, urgent: bool = False):
+        """Queue a notice for the next digest, or send it right away if urgent.
+
+        Before start() there is no client to send with, so everything is held until it is called.
+        """
+        if urgent and self.client is None:
+            self.held.append(text)
+            return
+        if urgent:
+            await self.send(text)
+            return
+        self.buffer.setdefault(category, []).append(text)
+        if sum(len(items) for items in self.buffer.values()) >= self.max_items:
+            self.flush_requested.set()
+
+    async def send(self, text: str) -> bool:
+        try:
+            await self.client.send_message(self.chat_id, text)
+            return True
+        except Exception as e:
+            logger.error(f"Failed to notify {self.chat_id}: {str(e)}")
+            return False
+
+    async def _send_held(self):
+        held, self.held = self.held, []
+        for text in held:
+            await self.send(text)
+
+    async def _run(self):
+        # Deliver what was raised before start(): urgent notices one by one, the rest as a digest now
+        await self._send_held()
+        if self.buffer:
+            self.flush_requested.set()
+        while True:
+            try:
+                await asyncio.wait_for(self.flush_requested.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.flush_requested.clear()
+            # Don't spend the send budget while the account is still penalized
+            if self.rate_limiter and self.rate_limiter.flood_remaining(SEND_MESSAGE_METHOD):
+                continue
+            await self.flush()
+
+    def _render(self, buffer: dict) -> list:
+        total = sum(len(items) for items in buffer.values())
+        lines = [f"Digest ({total} notices):"]
+        for category, items in buffer.items():
+            lines.append(f"\n{category} ({len(items)}):")
+            lines.extend(f"- {item}" for item in items)
+        chunks = [""]
+        for line in lines:
+            if chunks[-1] and len(chunks[-1]) + len(line) + 1 > MAX_MESSAGE_LENGTH:
+                chunks.append("")
+            chunks[-1] += ("\n" if chunks[-1] else "") + line[:MAX_MESSAGE_LENGTH]
+        return chunks
+
+    async def flush(self):
+        """Send everything buffered as one digest (split only to fit Telegram's length limit)."""
+        if not self.buffer or self.client is None:
+            return
+        buffer, self.buffer = self.buffer, {}
+        try:
+            for chunk in self._render(buffer):
+                await self.client.send_message(self.chat_id, chunk)
+            logger.info(f"Sent admin digest with {sum(len(items) for items in buffer.values())} notices")
+        except FloodWait as e:
+            # Put the notices back; the next digest picks them up after the wait
+            for category, items in buffer.items():
+                self.buffer.setdefault(category, [])[:0] = items
+            logger.warning(f"Flood wait {e.value}s while sending admin digest, deferring")
+        except Exception as e:
+            logger.error(f"Failed to send admin digest: {str(e)}")
@@ -0,0 +1,81 @@
+# planner.py
+from collections import Counter
+from datetime import datetime
+from registry import ChatRecord, ChatRegistry
+
+PRIVILEGES_MAX_AGE = 86400  # Seconds cached privileges are trusted without re-validation
+
+# Estimated RPCs per step of promote_bot_all / promote_in_chat
+RPC_COST = {
+    "validate": 1,  # is_chat_valid: get_chat
+    "admin_check": 4,  # is_bot_admin: get_chat_member, get_chat and two test promotions
+    "status": 1,  # get_user_status: get_chat_member
+    "unban": 1,  # unban_chat_member
+    "direct_invite": 2,  # get_chat, add_chat_members
+    "link_invite": 4,  # get_chat, rejected add_chat_members, create_chat_invite_link, send_message
+    "await_join": 8,  # promote_with_timeout polling, admin check and promotion after the join
+    "promote": 1,  # promote_chat_member
+}
+
+VERDICTS = ["promotable", "invite", "unknown", "no_permission", "dead"]
+
+def plan_bot(chat: ChatRecord, bot_id: int) -> tuple:
+    """Return (action, rpcs) for promoting one bot in a chat whose privileges are known."""
+    status = (chat.members or {}).get(str(bot_id))
+    if status in ["member", "administrator", "creator"]:
+        return "promote", RPC_COST["status"] + RPC_COST["promote"]
+    rpcs = RPC_COST["status"] + (RPC_COST["unban"] if status == "banned" else 0)
+    if chat.invite_mode == "link":
+        return "link_invite", rpcs + RPC_COST["link_invite"] + RPC_COST["await_join"]
+    return "direct_invite", rpcs + RPC_COST["direct_invite"] + RPC_COST["promote"]
+
+def plan_chat(chat: ChatRecord, bot_ids: list, stale: bool) -> dict:
+    """Classify one stored chat from its cached state without any RPCs; stale chats need live verification."""
+    if chat.verdict == "dead":
+        return {"verdict": "dead", "rpcs": 0, "actions": {}}
+    if stale:
+        # Needs the full live path: validation, admin check, then a direct invite at worst
+        rpcs = RPC_COST["validate"] + RPC_COST["admin_check"] + len(bot_ids) * (
+            RPC_COST["status"] + RPC_COST["direct_invite"] + RPC_COST["promote"]
+        )
+        return {"verdict": "unknown", "rpcs": rpcs, "actions": {}}
+    if chat.verdict == "no_permission":
+        return {"verdict": "no_permission", "rpcs": 0, "actions": {}}
+    actions = {}
+    rpcs = 0
+    for bot_id in bot_ids:
+        actions[bot_id], cost = plan_bot(chat, bot_id)
+        rpcs += cost
+    verdict = "invite" if "link_invite" in actions.values() else "promotable"
+    return {"verdict": verdict, "rpcs": rpcs, "actions": actions, "privileges": chat.privileges}
+
+def build_plan(chats: ChatRegistry, targets: list, rate: float, flood_remaining: float = 0.0) -> dict:
+    """Plan a /promoteall run for targets [(bot_id, bot_username)] over the chat registry."""
+    bot_ids = [bot_id for bot_id, _ in targets]
+    stale = {record.chat_id for record in chats.stale(PRIVILEGES_MAX_AGE)}
+    entries = {chat.chat_id: plan_chat(chat, bot_ids, chat.chat_id in stale) for chat in chats}
+    rpcs = sum(entry["rpcs"] for entry in entries.values())
+    return {
+        "created_at": datetime.utcnow(),
+        "targets": targets,
+        "chats": entries,
+        "counts": Counter(entry["verdict"] for entry in entries.values()),
+        "rpcs": rpcs,
+        "duration": rpcs / rate + flood_remaining,
+        "rate": rate,
+    }
+
+def format_plan(plan: dict) -> str:
+    """Render a plan summary for the admin."""
+    counts = plan["counts"]
+    lines = [
+        f"Plan for {', '.join('@' + bot_username for _, bot_username in plan['targets'])} "
+        f"across {len(plan['chats'])} chats:",
+        f"- Promotable: {counts['promotable']}",
+        f"- Needs invite-link fallback: {counts['invite']}",
+        f"- Needs live verification: {counts['unknown']}",
+        f"- Missing permissions: {counts['no_permission']}",
+        f"- Dead (circuit open): {counts['dead']}",
+        f"Estimated {plan['rpcs']} RPCs, ~{plan['duration'] / 60:.1f} min at {plan['rate']:.2f} calls/s.",
+    ]
+    return "\n".join(lines)
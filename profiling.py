@@ -0,0 +1,117 @@
+# profiling.py
+import asyncio
+import functools
+import logging
+import sys
+import time
+from collections import Counter
+from config import ENABLE_PROFILING
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_INTERVAL = 0.005  # Seconds between stack samples taken by sample_thread()
+LOOP_LAG_INTERVAL = 0.5  # Seconds between event-loop lag probes
+LOOP_LAG_THRESHOLD = 0.1  # Seconds of lag that get logged as a blocked loop
+
+# Timing spans collected by @timed: {name: {"calls": int, "total": float, "max": float}}
+span_stats = {}
+# Event-loop lag seen by monitor_loop_lag(): {"probes": int, "blocked": int, "max": float}
+loop_lag_stats = {"probes": 0, "blocked": 0, "max": 0.0}
+
+def _record_span(name: str, elapsed: float):
+    stats = span_stats.setdefault(name, {"calls": 0, "total": 0.0, "max": 0.0})
+    stats["calls"] += 1
+    stats["total"] += elapsed
+    stats["max"] = max(stats["max"], elapsed)
+
+def timed(func):
+    """Record a timing span for every call of func when ENABLE_PROFILING is set."""
+    if not ENABLE_PROFILING:
+        return func
+    name = func.__qualname__
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                _record_span(name, time.perf_counter() - started)
+    else:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _record_span(name, time.perf_counter() - started)
+    return wrapper
+
+def instrument_logging():
+    """Time every log record emitted through the root logger's handlers."""
+    if not ENABLE_PROFILING:
+        return
+    for handler in logging.getLogger().handlers:
+        handler.handle = functools.wraps(handler.handle)(
+            _timed_handle(handler.handle, f"logging.{type(handler).__name__}")
+        )
+
+def _timed_handle(handle, name: str):
+    def wrapper(record):
+        started = time.perf_counter()
+        try:
+            return handle(record)
+        finally:
+            _record_span(name, time.perf_counter() - started)
+    return wrapper
+
+async def monitor_loop_lag(interval: float = LOOP_LAG_INTERVAL, threshold: float = LOOP_LAG_THRESHOLD):
+    """Warn whenever the event loop wakes up late because something blocked it."""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        lag = loop.time() - expected
+        loop_lag_stats["probes"] += 1
+        loop_lag_stats["max"] = max(loop_lag_stats["max"], lag)
+        if lag > threshold:
+            loop_lag_stats["blocked"] += 1
+            logger.warning(f"Event loop was blocked for {lag * 1000:.0f}ms")
+
+def sample_thread(thread_id: int, seconds: float, interval: float = SAMPLE_INTERVAL) -> Counter:
+    """Sample a thread's Python stack for the given duration. Blocking; run it in a worker thread."""
+    samples = Counter()
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+            frame = frame.f_back
+        if stack:
+            samples[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+    return samples
+
+def format_report(samples: Counter, seconds: float, top: int = 30) -> str:
+    """Render hot functions, timing spans and loop lag, followed by collapsed stacks for flame graphs."""
+    total = sum(samples.values()) or 1
+    leaves = Counter()
+    for stack, count in samples.items():
+        leaves[stack.rsplit(";", 1)[-1]] += count
+    lines = [f"Sampled the event loop thread for {seconds}s ({total} samples)", "", "Hot functions (self time):"]
+    lines.extend(f"{count * 100 / total:6.1f}%  {leaf}" for leaf, count in leaves.most_common(top))
+    if span_stats:
+        lines += ["", "Timing spans (calls, total s, avg ms, max ms):"]
+        for name, stats in sorted(span_stats.items(), key=lambda item: item[1]["total"], reverse=True):
+            lines.append(
+                f"{name}: {stats['calls']}, {stats['total']:.2f}, "
+                f"{stats['total'] * 1000 / stats['calls']:.1f}, {stats['max'] * 1000:.1f}"
+            )
+    if loop_lag_stats["probes"]:
+        lines += ["", f"Event loop lag: {loop_lag_stats['blocked']}/{loop_lag_stats['probes']} probes blocked, "
+                      f"max {loop_lag_stats['max'] * 1000:.0f}ms"]
+    lines += ["", "Collapsed stacks:"]
+    lines.extend(f"{stack} {count}" for stack, count in samples.most_common())
+    return "\n".join(lines)
@@ -0,0 +1,81 @@
+# ratelimit.py
+import asyncio
+import time
+from collections import deque
+
+DEFAULT_RATE = 1.0  # Calls per second assumed until enough calls have been observed
+
+class RateLimiter:
+    """Track RPC throughput and FloodWait penalties per Telegram method."""
+
+    def __init__(self, window: float = 300, min_samples: int = 20, min_interval: float = 0.0):
+        self.window = window  # Seconds of call history kept for rate estimates
+        self.min_samples = min_samples
+        self.min_interval = min_interval  # Minimum spacing between calls made through acquire()
+        self.next_slot = 0.0  # Unix time of the next free acquire() slot
+        self.calls = {}  # {method: deque of call timestamps}
+        self.flood_until = {}  # {method: unix time the FloodWait penalty ends}
+
+    def _trim(self, calls: deque, now: float):
+        while calls and now - calls[0] > self.window:
+            calls.popleft()
+
+    def record_call(self, method: str):
+        now = time.time()
+        calls = self.calls.setdefault(method, deque())
+        calls.append(now)
+        self._trim(calls, now)
+
+    async def acquire(self, method: str):
+        """Wait out any FloodWait on method and keep calls min_interval apart, then record the call."""
+        remaining = self.flood_remaining(method)
+        if remaining:
+            await asyncio.sleep(remaining)
+        if self.min_interval:
+            now = time.time()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.min_interval
+            if slot > now:
+                await asyncio.sleep(slot - now)
+        self.record_call(method)
+
+    def record_flood(self, method: str, seconds: float):
+        self.flood_until[method] = max(self.flood_until.get(method, 0), time.time() + seconds)
+
+    def flood_remaining(self, method: str = None) -> float:
+        """Seconds left on the FloodWait for method, or the longest one if method is None."""
+        now = time.time()
+        deadlines = self.flood_until.values() if method is None else [self.flood_until.get(method, 0)]
+        return max([deadline - now for deadline in deadlines] + [0.0])
+
+    def snapshot(self) -> dict:
+        """State worth keeping across restarts: live FloodWait deadlines and recent calls."""
+        now = time.time()
+        for calls in self.calls.values():
+            self._trim(calls, now)
+        return {
+            "flood_until": {method: deadline for method, deadline in self.flood_until.items() if deadline > now},
+            "calls": {method: list(calls) for method, calls in self.calls.items() if calls},
+        }
+
+    def restore(self, state: dict):
+        """Merge a snapshot() taken by an earlier run; expired deadlines and old calls are dropped."""
+        now = time.time()
+        for method, deadline in state["flood_until"].items():
+            if deadline > now:
+                self.flood_until[method] = max(self.flood_until.get(method, 0), deadline)
+        for method, stamps in state["calls"].items():
+            calls = self.calls[method] = deque(sorted([*stamps, *self.calls.get(method, [])]))
+            self._trim(calls, now)
+
+    def observed_rate(self) -> float:
+        """Calls per second sustained over the busy part of the window."""
+        now = time.time()
+        stamps = []
+        for calls in self.calls.values():
+            self._trim(calls, now)
+            stamps.extend(calls)
+        if len(stamps) < self.min_samples:
+            return DEFAULT_RATE
+        span = max(stamps) - min(stamps)
+        return len(stamps) / span if span > 0 else DEFAULT_RATE
@@ -0,0 +1,159 @@
+# registry.py
+import time
+from datetime import datetime
+from pyrogram.types import ChatPrivileges
+
+CIRCUIT_FAILURE_THRESHOLD = 3  # Consecutive failed validations before a chat is treated as dead
+
+# Admin privileges the bot copies onto promoted bots, one bit each
+PRIVILEGE_FLAGS = [
+    "can_manage_chat",
+    "can_delete_messages",
+    "can_manage_video_chats",
+    "can_restrict_members",
+    "can_promote_members",
+    "can_change_info",
+    "can_invite_users",
+    "can_pin_messages",
+]
+PRIVILEGE_BITS = {name: 1 << index for index, name in enumerate(PRIVILEGE_FLAGS)}
+CAN_PROMOTE_MEMBERS = PRIVILEGE_BITS["can_promote_members"]
+
+def encode_privileges(privileges) -> int:
+    """Pack a ChatPrivileges object or a privileges dict into a bitmask."""
+    if privileges is None:
+        return 0
+    if isinstance(privileges, int):
+        return privileges
+    get = privileges.get if isinstance(privileges, dict) else lambda name: getattr(privileges, name, False)
+    mask = 0
+    for name, bit in PRIVILEGE_BITS.items():
+        if get(name):
+            mask |= bit
+    return mask
+
+def privilege_names(mask: int) -> list:
+    return [name for name, bit in PRIVILEGE_BITS.items() if mask & bit]
+
+def to_chat_privileges(mask: int) -> ChatPrivileges:
+    """Build the ChatPrivileges to grant from a bitmask."""
+    return ChatPrivileges(**{name: bool(mask & bit) for name, bit in PRIVILEGE_BITS.items()})
+
+def _timestamp(value) -> float:
+    if isinstance(value, datetime):
+        # Stored datetimes are naive UTC
+        return (value - datetime(1970, 1, 1)).total_seconds()
+    return value
+
+class ChatRecord:
+    """Compact state for one stored chat."""
+    __slots__ = (
+        "chat_id", "chat_type", "title", "privileges", "checked_at",
+        "failures", "failed_at", "members", "invite_mode", "verdict",
+    )
+
+    def __init__(self, chat_id: int):
+        self.chat_id = chat_id
+        self.chat_type = None
+        self.title = None
+        self.privileges = None  # Bitmask from the last admin check, None if never checked
+        self.checked_at = None  # Unix time of the last admin check
+        self.failures = 0  # Consecutive failed validations
+        self.failed_at = None  # Unix time of the last failed validation
+        self.members = None  # {str(user_id): last seen status} for bots we promote
+        self.invite_mode = None  # "direct" or "link", whichever invites last needed
+        self.verdict = "unknown"
+
+    def refresh_verdict(self):
+        if self.failures >= CIRCUIT_FAILURE_THRESHOLD:
+            self.verdict = "dead"
+        elif self.privileges is None:
+            self.verdict = "unknown"
+        elif self.privileges & CAN_PROMOTE_MEMBERS:
+            self.verdict = "promotable"
+        else:
+            self.verdict = "no_permission"
+
+class ChatRegistry:
+    """In-memory index of stored chats, kept in sync with the chats collection."""
+
+    # Mongo document fields and the record attributes they map to
+    FIELDS = {
+        "chat_type": "chat_type",
+        "chat_title": "title",
+        "privileges": "privileges",
+        "checked_at": "checked_at",
+        "failures": "failures",
+        "failed_at": "failed_at",
+        "members": "members",
+        "invite_mode": "invite_mode",
+    }
+
+    def __init__(self):
+        self.records = {}  # {chat_id: ChatRecord}
+
+    def __contains__(self, chat_id: int) -> bool:
+        return chat_id in self.records
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(list(self.records.values()))
+
+    def get(self, chat_id: int) -> ChatRecord:
+        return self.records.get(chat_id)
+
+    def load(self, docs: list):
+        self.records = {}
+        for doc in docs:
+            self.apply(doc["chat_id"], doc)
+
+    def apply(self, chat_id: int, fields: dict) -> ChatRecord:
+        """Apply chat document fields to the record for chat_id, creating it if needed."""
+        record = self.records.get(chat_id)
+        if record is None:
+            record = self.records[chat_id] = ChatRecord(chat_id)
+        for field, attr in self.FIELDS.items():
+            if field not in fields:
+                continue
+            value = fields[field]
+            if field == "privileges" and value is not None:
+                value = encode_privileges(value)
+            elif field in ["checked_at", "failed_at"]:
+                value = _timestamp(value)
+            elif field == "failures":
+                value = value or 0
+            setattr(record, attr, value)
+        record.refresh_verdict()
+        return record
+
+    def remove(self, chat_id: int):
+        self.records.pop(chat_id, None)
+
+    def promotable(self):
+        return [record for record in self.records.values() if record.verdict == "promotable"]
+
+    @staticmethod
+    def _stale(record: ChatRecord, now: float, max_age: float, retry_dead_after: float = None) -> bool:
+        if record.checked_at is not None and now - record.checked_at <= max_age:
+            return False
+        if record.verdict != "dead":
+            return True
+        return retry_dead_after is not None and (record.failed_at is None or now - record.failed_at >= retry_dead_after)
+
+    def is_stale(self, chat_id: int, max_age: float, retry_dead_after: float = None) -> bool:
+        """Whether chat_id needs a fresh admin check; chats not in the registry always do."""
+        record = self.records.get(chat_id)
+        return record is None or self._stale(record, time.time(), max_age, retry_dead_after)
+
+    def stale(self, max_age: float, retry_dead_after: float = None):
+        """Records whose admin check is older than max_age (or missing).
+
+        Dead chats are left out, unless retry_dead_after is given and their last failure is at least that old.
+        """
+        now = time.time()
+        return [record for record in self.records.values() if self._stale(record, now, max_age, retry_dead_after)]
+
+    def dead(self):
+        return [record for record in self.records.values() if record.verdict == "dead"]
@@ -0,0 +1,340 @@
+# replay.py
+"""Replay a trace recorded with TRACE_FILE against the bot's handlers, offline and on a virtual clock.
+
+Usage: python replay.py traffic.jsonl [--json report.json] [--grace SECONDS] [--verbose]
+
+Each restart of the recording bot appends a new session to the trace; the last one is replayed.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import selectors
+import sys
+import time
+from collections import Counter, deque
+from datetime import datetime, timedelta
+from pyrogram import errors, raw
+import bot
+import database
+import planner
+from database import MongoDB
+from tracing import RECORDED_METHODS, call_args, decode
+
+REPLAY_GRACE = 120  # Virtual seconds to keep running after the last event so timers and invite waits play out
+# Command name -> bot.py handler replayed for it
+COMMAND_HANDLERS = {
+    "addchat": bot.add_chat,
+    "cleandb": bot.clean_db,
+    "promote": bot.promote_bot,
+    "promoteall": bot.promote_bot_all,
+    "start": bot.start,
+    "init": bot.init,
+}
+
+class ReplayMiss(Exception):
+    """Raised for an RPC the trace has no answer for."""
+
+class VirtualClock:
+    """Time that only moves when the event loop would otherwise wait."""
+
+    def __init__(self, wall: float):
+        self.wall = wall  # Unix time the recording started at
+        self.elapsed = 0.0
+
+    def time(self) -> float:
+        return self.wall + self.elapsed
+
+class _VirtualSelector(selectors.DefaultSelector):
+    def __init__(self, clock: VirtualClock):
+        super().__init__()
+        self.clock = clock
+
+    def select(self, timeout=None):
+        ready = super().select(0)
+        if not ready:
+            if timeout is None:
+                raise RuntimeError("Replay stalled: nothing is scheduled and no I/O can arrive")
+            # Jump straight to the next timer instead of sleeping
+            self.clock.elapsed += timeout
+        return ready
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    """Event loop whose sleeps and timeouts complete instantly, in a deterministic order."""
+
+    def __init__(self, clock: VirtualClock):
+        super().__init__(_VirtualSelector(clock))
+        self.clock = clock
+
+    def time(self) -> float:
+        return self.clock.elapsed
+
+class _VirtualDatetime(datetime):
+    clock = None
+
+    @classmethod
+    def utcnow(cls):
+        return datetime(1970, 1, 1) + timedelta(seconds=cls.clock.time())
+
+async def _run_inline(func, *args, **kwargs):
+    # Replayed database calls are in-memory, so running them on the loop keeps the order deterministic
+    return func(*args, **kwargs)
+
+@contextlib.contextmanager
+def virtual_time(clock: VirtualClock):
+    """Point wall-clock reads and to_thread() at the replay for the duration of the block."""
+    modules = [bot, database, planner]
+    saved = (time.time, asyncio.to_thread, [module.datetime for module in modules])
+    _VirtualDatetime.clock = clock
+    time.time = clock.time
+    asyncio.to_thread = _run_inline
+    for module in modules:
+        module.datetime = _VirtualDatetime
+    try:
+        yield
+    finally:
+        time.time, asyncio.to_thread = saved[0], saved[1]
+        for module, original in zip(modules, saved[2]):
+            module.datetime = original
+
+class ReplayDatabase(MongoDB):
+    """MongoDB whose writes stay in memory and are only counted."""
+
+    def __init__(self):
+        super().__init__()
+        self.writes = Counter()
+        self.sweep_checkpoint = None
+
+    def load_snapshot(self, snapshot: dict):
+        self.chats.load(snapshot["chats"])
+        for peer in snapshot.get("peers", []):
+            peer = {**peer, "updated_at": datetime(1970, 1, 1) + timedelta(seconds=peer["updated_at"])}
+            self.peers[peer["peer_id"]] = peer
+            self.usernames[peer["username"]] = peer["peer_id"]
+
+    def save_chat(self, chat_id: int, chat_type: str, chat_title: str, privileges: int = None):
+        self.writes["save_chat"] += 1
+        self.chats.apply(chat_id, self._chat_fields(chat_type, chat_title, privileges))
+        self.pending_chats.pop(chat_id, None)
+        return True
+
+    def delete_chat(self, chat_id: int):
+        self.writes["delete_chat"] += 1
+        existed = chat_id in self.chats
+        self.chats.remove(chat_id)
+        self.pending_chats.pop(chat_id, None)
+        return existed
+
+    def flush_pending(self):
+        flushed = len(self.pending_chats) + len(self.pending_peers)
+        if flushed:
+            self.writes["flush_pending"] += 1
+        self.pending_chats, self.pending_peers = {}, {}
+        return flushed
+
+    def get_sweep_checkpoint(self):
+        return self.sweep_checkpoint
+
+    def save_sweep_checkpoint(self, offset: dict):
+        self.writes["save_sweep_checkpoint"] += 1
+        self.sweep_checkpoint = offset
+        return True
+
+    def save_rate_state(self, state: dict):
+        self.writes["save_rate_state"] += 1
+        return True
+
+    def save_invite(self, chat_id: int, user_id: int, link: str, expires: datetime):
+        self.writes["save_invite"] += 1
+        return True
+
+    def delete_invite(self, chat_id: int, user_id: int):
+        self.writes["delete_invite"] += 1
+        return True
+
+class _ReplaySession:
+    async def restart(self):
+        pass
+
+class ReplayClient:
+    """Stands in for PromoterClient, answering RPCs with the recorded results after the recorded latency."""
+
+    def __init__(self, rpcs: list):
+        self.answers = {}  # {(method, args): deque of recorded rpc events, in recorded order}
+        self.last_answers = {}  # {(method, args): last event used}, reused once the queue runs dry
+        self.method_answers = {}  # {method: last recorded event}, the fallback for unseen arguments
+        for event in rpcs:
+            key = (event["method"], json.dumps(event["args"]))
+            self.answers.setdefault(key, deque()).append(event)
+            self.method_answers[event["method"]] = event
+        self.calls = Counter()  # {method: calls made}
+        self.invokes = Counter()  # {raw TL method: RPCs those calls would have sent}
+        self.latency = 0.0  # Summed RPC latency
+        self.reused = Counter()  # {method: calls answered with a recorded result for other or repeated arguments}
+        self.misses = Counter()  # {method: calls the trace had no answer for}
+        self.rpc_ready = asyncio.Event()
+        self.rpc_ready.set()
+        self.recovery_lock = asyncio.Lock()
+        self.last_recovery = 0.0
+        self.session = _ReplaySession()
+
+    def _answer(self, method: str, args: list) -> dict:
+        key = (method, json.dumps(args, default=str))
+        queue = self.answers.get(key)
+        if queue:
+            self.last_answers[key] = queue.popleft()
+            return self.last_answers[key]
+        event = self.last_answers.get(key) or self.method_answers.get(method)
+        if event:
+            self.reused[method] += 1
+        return event
+
+    async def _call(self, method: str, args: tuple, kwargs: dict):
+        self.calls[method] += 1
+        event = self._answer(method, call_args(method, args, kwargs))
+        if event is None:
+            self.misses[method] += 1
+            raise ReplayMiss(f"No recorded answer for {method}")
+        for query in event["invokes"]:
+            self.invokes[query] += 1
+            bot.rate_limiter.record_call(query)
+        self.latency += event["latency"]
+        await asyncio.sleep(event["latency"])
+        if "error" in event:
+            raise _rebuild_error(event["error"], event["invokes"])
+        return decode(event.get("result"), self)
+
+    def __getattr__(self, name: str):
+        if name == "get_chat_members":
+            async def method(*args, **kwargs):
+                for item in await self._call(name, args, kwargs):
+                    yield item
+            return method
+        if name in RECORDED_METHODS:
+            async def method(*args, **kwargs):
+                return await self._call(name, args, kwargs)
+            return method
+        raise AttributeError(name)
+
+    async def resolve_peer(self, peer_id):
+        return raw.types.InputPeerEmpty()
+
+def _rebuild_error(error: dict, invokes: list) -> Exception:
+    cls = getattr(errors, error["type"], None)
+    if cls is not None:
+        if issubclass(cls, errors.FloodWait) and invokes:
+            bot.rate_limiter.record_flood(invokes[-1], error["value"])
+        return cls(value=error["value"])
+    if error["type"] in ["TimeoutError", "ConnectionError"]:
+        return {"TimeoutError": asyncio.TimeoutError, "ConnectionError": ConnectionError}[error["type"]]()
+    return Exception(error["type"])
+
+def load_trace(path: str) -> list:
+    """Return the events of the last recording session in the trace."""
+    with open(path) as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    starts = [index for index, event in enumerate(events) if event["kind"] == "snapshot"]
+    return events[starts[-1]:] if starts else []
+
+async def replay(events: list, grace: float = REPLAY_GRACE) -> dict:
+    """Feed the trace's updates and commands to the handlers at their recorded times and report the result."""
+    loop = asyncio.get_running_loop()
+    snapshot = events[0]
+    rpcs = [event for event in events if event["kind"] == "rpc"]
+    client = ReplayClient(rpcs)
+    db = ReplayDatabase()
+    db.load_snapshot(snapshot)
+    bot.mongo_db = db
+    bot.recorder = None
+    bot.bot_identity = decode(snapshot["me"], client)
+    bot.notifier.start(client)
+
+    commands = []
+    command_tasks = []
+
+    async def run_command(name: str, message):
+        started = loop.time()
+        await COMMAND_HANDLERS[name](client, message)
+        commands.append({"command": name, "at": round(started, 3), "duration": round(loop.time() - started, 3)})
+
+    replayed = Counter()
+    for event in events:
+        if event["kind"] not in ["update", "command", "sweep"]:
+            continue
+        if event["t"] > loop.time():
+            await asyncio.sleep(event["t"] - loop.time())
+        replayed[event["kind"]] += 1
+        if event["kind"] == "update":
+            await bot.on_chat_member_updated(client, decode(event["update"], client))
+        elif event["kind"] == "command":
+            message = decode(event["message"], client)
+            name = message.text.split()[0].lstrip("/")
+            if name in COMMAND_HANDLERS:
+                command_tasks.append(asyncio.create_task(run_command(name, message)))
+        else:
+            bot.start_sweep(client)
+    await asyncio.sleep(grace)
+    if command_tasks:
+        await asyncio.gather(*command_tasks, return_exceptions=True)
+    await bot.shutdown(client)
+
+    recorded_invokes = Counter(query for event in rpcs for query in event["invokes"])
+    return {
+        "events": dict(replayed),
+        "duration": round(loop.time(), 3),
+        "calls": {"recorded": dict(Counter(event["method"] for event in rpcs)), "replayed": dict(client.calls)},
+        "rpcs": {"recorded": dict(recorded_invokes), "replayed": dict(client.invokes)},
+        "latency": {"recorded": round(sum(event["latency"] for event in rpcs), 3), "replayed": round(client.latency, 3)},
+        "reused": dict(client.reused),
+        "misses": dict(client.misses),
+        "db_writes": dict(db.writes),
+        "commands": commands,
+    }
+
+def format_report(report: dict) -> str:
+    events = ", ".join(f"{kind}: {count}" for kind, count in report["events"].items())
+    lines = [f"Replayed events ({events}) over {report['duration']:.1f} virtual seconds"]
+    for section, title in [("calls", "Client calls"), ("rpcs", "Telegram RPCs")]:
+        recorded, replayed = report[section]["recorded"], report[section]["replayed"]
+        lines.append(f"{title} (recorded -> replayed): {sum(recorded.values())} -> {sum(replayed.values())}")
+        for method in sorted(set(recorded) | set(replayed)):
+            lines.append(f"  {method}: {recorded.get(method, 0)} -> {replayed.get(method, 0)}")
+    lines.append(f"RPC latency (recorded -> replayed): {report['latency']['recorded']:.2f}s -> {report['latency']['replayed']:.2f}s")
+    if report["reused"]:
+        lines.append(f"Answered with results recorded for other arguments: {report['reused']}")
+    if report["misses"]:
+        lines.append(f"Unanswered (no recorded result): {report['misses']}")
+    if report["db_writes"]:
+        lines.append(f"Database writes: {report['db_writes']}")
+    for command in report["commands"]:
+        lines.append(f"/{command['command']} at {command['at']:.1f}s took {command['duration']:.2f}s")
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded trace against the bot's handlers")
+    parser.add_argument("trace", help="JSON lines trace written with TRACE_FILE set")
+    parser.add_argument("--json", help="Also write the report to this file, to diff runs before and after a change")
+    parser.add_argument("--grace", type=float, default=REPLAY_GRACE, help="Virtual seconds to run after the last event")
+    parser.add_argument("--verbose", action="store_true", help="Show the handlers' info logs")
+    options = parser.parse_args()
+    if not options.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    events = load_trace(options.trace)
+    if not events:
+        sys.exit(f"{options.trace} has no snapshot; was it recorded with TRACE_FILE set?")
+    clock = VirtualClock(events[0]["wall"])
+    loop = VirtualClockLoop(clock)
+    try:
+        with virtual_time(clock):
+            report = loop.run_until_complete(replay(events, options.grace))
+    finally:
+        loop.close()
+    print(format_report(report))
+    if options.json:
+        with open(options.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
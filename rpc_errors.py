@@ -0,0 +1,77 @@
+# rpc_errors.py
+import asyncio
+from collections import namedtuple
+from pyrogram import errors
+
+# Error classes; every RPC failure maps to exactly one
+TRANSIENT = "transient"  # Server hiccups and timeouts: retry with backoff
+RATE_LIMITED = "rate_limited"  # FloodWait and friends: wait as long as Telegram says, then retry
+PERMANENT_CHAT = "permanent_chat"  # The chat is gone or closed to us: don't retry, count towards its circuit
+PERMANENT_PERMISSION = "permanent_permission"  # We lack the admin right needed: don't retry
+PERMANENT_USER = "permanent_user"  # The user peer can't be resolved: don't retry, and don't blame the chat
+NEEDS_INVITE = "needs_invite"  # The user isn't in the chat or can't be added directly: invite instead
+PERMANENT = "permanent"  # Any other rejected request: don't retry
+
+RetryPolicy = namedtuple("RetryPolicy", ["retries", "backoff", "max_delay", "trips_circuit"])
+
+# How each error class is retried: attempts after the first, base delay doubled per attempt,
+# cap on any single wait, and whether the failure counts against the chat's circuit breaker
+POLICIES = {
+    TRANSIENT: RetryPolicy(retries=3, backoff=1.0, max_delay=30, trips_circuit=False),
+    RATE_LIMITED: RetryPolicy(retries=2, backoff=0.0, max_delay=600, trips_circuit=False),
+    PERMANENT_CHAT: RetryPolicy(retries=0, backoff=0.0, max_delay=0, trips_circuit=True),
+    PERMANENT_PERMISSION: RetryPolicy(retries=0, backoff=0.0, max_delay=0, trips_circuit=False),
+    PERMANENT_USER: RetryPolicy(retries=0, backoff=0.0, max_delay=0, trips_circuit=False),
+    NEEDS_INVITE: RetryPolicy(retries=0, backoff=0.0, max_delay=0, trips_circuit=False),
+    PERMANENT: RetryPolicy(retries=0, backoff=0.0, max_delay=0, trips_circuit=False),
+}
+
+CIRCUIT_RESET = 86400  # Seconds after the last failure before an open chat circuit lets one attempt through
+
+class UserPeerInvalid(errors.PeerIdInvalid):
+    """PEER_ID_INVALID raised while resolving the user side of a call, not the chat."""
+
+# Exception types and their class; the first matching entry wins, so specific errors come first
+ERROR_CLASSES = [
+    (errors.Flood, RATE_LIMITED),
+    (errors.UserNotParticipant, NEEDS_INVITE),
+    (errors.BotMethodInvalid, NEEDS_INVITE),
+    (errors.ChatWriteForbidden, NEEDS_INVITE),
+    (UserPeerInvalid, PERMANENT_USER),
+    (errors.PeerIdInvalid, PERMANENT_CHAT),
+    (errors.ChannelPrivate, PERMANENT_CHAT),
+    (errors.ChannelInvalid, PERMANENT_CHAT),
+    (errors.ChatIdInvalid, PERMANENT_CHAT),
+    (errors.ChatInvalid, PERMANENT_CHAT),
+    (errors.ChatForbidden, PERMANENT_CHAT),
+    (errors.ChatAdminInviteRequired, PERMANENT_PERMISSION),
+    (errors.ChatAdminRequired, PERMANENT_PERMISSION),
+    (errors.RightForbidden, PERMANENT_PERMISSION),
+    (errors.UserAdminInvalid, PERMANENT_PERMISSION),
+    (errors.InternalServerError, TRANSIENT),
+    (errors.ServiceUnavailable, TRANSIENT),
+    (asyncio.TimeoutError, TRANSIENT),
+    (ConnectionError, TRANSIENT),
+]
+
+# Exceptions an RPC call can fail with that are worth classifying
+RPC_EXCEPTIONS = (errors.RPCError, asyncio.TimeoutError, ConnectionError)
+
+# Errors that mean the MTProto session itself needs recovering before a retry
+SESSION_ERRORS = (errors.RandomIdDuplicate,)
+
+def classify(error: Exception) -> str:
+    for error_type, error_class in ERROR_CLASSES:
+        if isinstance(error, error_type):
+            return error_class
+    return PERMANENT
+
+def retry_delay(error: Exception, attempt: int) -> float:
+    """Seconds to wait before retry number attempt + 1, or None if the error must not be retried."""
+    policy = POLICIES[classify(error)]
+    if attempt >= policy.retries:
+        return None
+    if isinstance(error, errors.Flood) and isinstance(error.value, int):
+        # Waits longer than the policy allows are better left to the caller than slept through
+        return error.value if error.value <= policy.max_delay else None
+    return min(policy.backoff * (2 ** attempt), policy.max_delay)
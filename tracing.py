@@ -0,0 +1,302 @@
+# tracing.py
+import asyncio
+import contextvars
+import enum
+import functools
+import inspect
+import json
+import logging
+import time
+from datetime import datetime
+from types import SimpleNamespace
+import pyrogram
+from pyrogram import Client, raw, utils
+
+logger = logging.getLogger(__name__)
+
+# Client methods the handlers call, and the arguments that identify a call when replaying it
+RECORDED_METHODS = {
+    "get_me": [],
+    "get_users": ["user_ids"],
+    "get_chat": ["chat_id"],
+    "get_chat_member": ["chat_id", "user_id"],
+    "get_chat_members": ["chat_id"],
+    "promote_chat_member": ["chat_id", "user_id"],
+    "unban_chat_member": ["chat_id", "user_id"],
+    "add_chat_members": ["chat_id", "user_ids"],
+    "create_chat_invite_link": ["chat_id"],
+    "send_message": ["chat_id"],
+    "invoke": ["query"],
+}
+# Results that are never needed on replay and would only leak message text into the trace
+DROPPED_RESULTS = ["send_message"]
+# Admin commands captured for replay; /profile is left out since it samples real threads
+RECORDED_COMMANDS = ["addchat", "cleandb", "promote", "promoteall", "start", "init"]
+# Fields holding peer IDs; "id" only counts outside messages, where it is a message ID
+ID_FIELDS = ["id", "chat_id", "user_id", "user_ids", "channel_id", "from_id", "linked_chat_id", "migrate_to_chat_id"]
+PSEUDONYM_START = 1000  # First pseudonymous peer ID handed out
+
+# Set while a recorded call runs: the raw RPCs it makes (nested invokes aren't recorded on their own)
+_current_invokes = contextvars.ContextVar("current_invokes", default=None)
+
+def call_args(method: str, args: tuple, kwargs: dict) -> list:
+    """Pick the arguments that identify a call to method; raw queries are named by their TL type."""
+    bound = inspect.signature(getattr(Client, method)).bind(None, *args, **kwargs)
+    values = [bound.arguments.get(name) for name in RECORDED_METHODS[method]]
+    return [value.QUALNAME if name == "query" else value for name, value in zip(RECORDED_METHODS[method], values)]
+
+class Anonymizer:
+    """Replace peer IDs, usernames and free text with stable pseudonyms."""
+
+    def __init__(self, keep_ids: list = ()):
+        self.ids = {peer_id: peer_id for peer_id in keep_ids}  # {real bare ID: pseudonym}
+        self.issued = set(self.ids.values())  # Pseudonyms in use, so new ones never collide with kept IDs
+        self.next_id = PSEUDONYM_START
+        self.names = {}  # {(kind, real value): pseudonym}
+
+    def peer_id(self, value: int) -> int:
+        # Channel and basic group IDs are mapped through their bare IDs, so the marked IDs
+        # handlers see and the bare IDs in raw results keep pointing at the same pseudonym
+        if value <= utils.MAX_CHANNEL_ID:
+            return utils.MAX_CHANNEL_ID - self._bare_id(utils.MAX_CHANNEL_ID - value)
+        if value < 0:
+            return -self._bare_id(-value)
+        return self._bare_id(value)
+
+    def _bare_id(self, value: int) -> int:
+        if value not in self.ids:
+            while self.next_id in self.issued:
+                self.next_id += 1
+            self.ids[value] = self.next_id
+            self.issued.add(self.next_id)
+            self.next_id += 1
+        return self.ids[value]
+
+    def name(self, kind: str, value: str) -> str:
+        key = (kind, value.lower() if kind == "user" else value)
+        if key not in self.names:
+            self.names[key] = f"{kind}{len(self.names) + 1}"
+        return self.names[key]
+
+    def peer(self, value):
+        """Anonymize a peer given as an ID, a username or a list of either."""
+        if isinstance(value, list):
+            return [self.peer(item) for item in value]
+        if isinstance(value, bool) or value is None:
+            return value
+        if isinstance(value, int):
+            return self.peer_id(value)
+        if isinstance(value, str):
+            return ("@" if value.startswith("@") else "") + self.name("user", value.lstrip("@"))
+        return value
+
+    def command(self, text: str) -> str:
+        """Anonymize the arguments of a command, keeping its name, flags and plan IDs."""
+        words = text.split()
+        result = [words[0].split("@")[0]]
+        for previous, word in zip(words, words[1:]):
+            if word.startswith("--") or previous == "--execute":
+                result.append(word)
+            elif word.lstrip("-").isdigit():
+                result.append(str(self.peer_id(int(word))))
+            else:
+                result.append(self.peer(word))
+        return " ".join(result)
+
+    def encode(self, value, field: str = None, parent: str = ""):
+        """Turn a Pyrogram object, raw TL object or plain value into anonymized JSON data."""
+        if value is None or isinstance(value, (bool, float)):
+            return value
+        if isinstance(value, enum.Enum):
+            return {"_enum": type(value).__name__, "name": value.name}
+        if isinstance(value, int):
+            if field in ID_FIELDS and not (field == "id" and "Message" in parent):
+                return self.peer_id(value)
+            return 0 if field == "access_hash" else value
+        if isinstance(value, str):
+            return self.name("user" if field == "username" else "text", value)
+        if isinstance(value, datetime):
+            return {"_datetime": value.isoformat()}
+        if isinstance(value, (list, tuple)):
+            return [self.encode(item, field, parent) for item in value]
+        if isinstance(value, pyrogram.types.Object):
+            name = type(value).__name__
+            fields = {key: self.encode(item, key, name) for key, item in vars(value).items() if not key.startswith("_")}
+            return {"_type": name, **fields}
+        if isinstance(value, raw.core.TLObject):
+            fields = {key: self.encode(getattr(value, key, None), key, value.QUALNAME) for key in value.__slots__}
+            return {"_raw": value.QUALNAME, **fields}
+        # Bytes (file references and the like) are never needed on replay
+        return None
+
+def decode(value, client=None):
+    """Rebuild objects from encode() output, bound to client so methods like Message.reply work."""
+    if isinstance(value, list):
+        return [decode(item, client) for item in value]
+    if not isinstance(value, dict):
+        return value
+    if "_enum" in value:
+        return getattr(pyrogram.enums, value["_enum"])[value["name"]]
+    if "_datetime" in value:
+        return datetime.fromisoformat(value["_datetime"])
+    fields = {key: decode(item, client) for key, item in value.items() if not key.startswith("_")}
+    if "_raw" in value:
+        cls = functools.reduce(getattr, value["_raw"].split("."), raw)
+        obj = cls.__new__(cls)
+        for key, item in fields.items():
+            setattr(obj, key, item)
+        return obj
+    cls = getattr(pyrogram.types, value["_type"], None)
+    if cls is None:
+        return SimpleNamespace(**fields)
+    obj = cls.__new__(cls)
+    obj.__dict__.update(fields)
+    obj._client = client
+    return obj
+
+class TraceRecorder:
+    """Append anonymized updates, admin commands and RPC results to a JSON lines trace for replay.py."""
+
+    def __init__(self, path: str, keep_ids: list = ()):
+        self.path = path
+        self.anonymizer = Anonymizer(keep_ids)
+        self.file = None
+        self.started = 0.0  # Loop time the recording started at
+
+    async def start(self, client: Client, database, me):
+        """Snapshot the cached chats, usernames and bot identity, then start recording client's RPCs."""
+        # Copy the caches on the loop, then anonymize them off it since large registries take a while
+        records = list(database.chats)
+        peers = [dict(peer) for peer in database.peers.values() if peer.get("username")]
+        snapshot = await asyncio.to_thread(self._snapshot, records, peers, me)
+        self.file = open(self.path, "a", buffering=1)
+        self.started = asyncio.get_running_loop().time()
+        self._write("snapshot", wall=time.time(), **snapshot)
+        for method in RECORDED_METHODS:
+            original = getattr(client, method)
+            wrapper = self._wrap_generator if inspect.isasyncgenfunction(original) else self._wrap
+            setattr(client, method, wrapper(method, original))
+        logger.info(
+            f"Recording anonymized traffic to {self.path} "
+            f"({len(snapshot['chats'])} chats, {len(snapshot['peers'])} usernames in snapshot)"
+        )
+
+    def _snapshot(self, records: list, peers: list, me) -> dict:
+        peer_id = self.anonymizer.peer_id
+        docs = [
+            {
+                "chat_id": peer_id(record.chat_id),
+                "chat_type": record.chat_type,
+                "chat_title": self.anonymizer.name("text", record.title) if record.title else None,
+                "privileges": record.privileges,
+                "checked_at": record.checked_at,
+                "failures": record.failures,
+                "failed_at": record.failed_at,
+                "members": {str(peer_id(int(user_id))): status for user_id, status in (record.members or {}).items()},
+                "invite_mode": record.invite_mode,
+            }
+            for record in records
+        ]
+        # resolve_user_id() answers from these without an RPC
+        peers = [
+            {
+                "peer_id": peer_id(peer["peer_id"]),
+                "peer_type": peer["peer_type"],
+                "username": self.anonymizer.name("user", peer["username"]),
+                "updated_at": (peer["updated_at"] - datetime(1970, 1, 1)).total_seconds(),
+            }
+            for peer in peers
+        ]
+        return {"me": self.anonymizer.encode(me), "chats": docs, "peers": peers}
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def _write(self, kind: str, **fields):
+        if self.file is None:
+            return
+        t = asyncio.get_running_loop().time() - self.started
+        self.file.write(json.dumps({"kind": kind, "t": round(t, 4), **fields}, default=str) + "\n")
+
+    def record_update(self, update):
+        self._write("update", update=self.anonymizer.encode(update))
+
+    def record_command(self, message):
+        self._write("command", message={
+            "_type": "Message",
+            "id": message.id,
+            "chat": self.anonymizer.encode(message.chat),
+            "from_user": self.anonymizer.encode(message.from_user),
+            "text": self.anonymizer.command(message.text or ""),
+        })
+
+    def record_sweep(self):
+        self._write("sweep")
+
+    def _record_call(self, method: str, args: tuple, kwargs: dict, latency: float, invokes: list, result=None, error=None):
+        args = call_args(method, args, kwargs)
+        event = {
+            "method": method,
+            # Raw queries are identified by their TL type name, which isn't a peer
+            "args": args if method == "invoke" else [self.anonymizer.peer(value) for value in args],
+            "latency": round(latency, 4),
+            "invokes": invokes,
+        }
+        if error is not None:
+            event["error"] = {"type": type(error).__name__, "value": getattr(error, "value", None)}
+        elif method not in DROPPED_RESULTS:
+            event["result"] = self.anonymizer.encode(result)
+        self._write("rpc", **event)
+
+    def _wrap(self, method: str, original):
+        async def wrapper(*args, **kwargs):
+            invokes = _current_invokes.get()
+            if invokes is not None:
+                # Part of a call that is already being recorded
+                if method == "invoke":
+                    invokes.append(args[0].QUALNAME if args else kwargs["query"].QUALNAME)
+                return await original(*args, **kwargs)
+            invokes = [call_args(method, args, kwargs)[0]] if method == "invoke" else []
+            token = _current_invokes.set(invokes)
+            loop = asyncio.get_running_loop()
+            started = loop.time()
+            try:
+                result = await original(*args, **kwargs)
+            except Exception as e:
+                self._record_call(method, args, kwargs, loop.time() - started, invokes, error=e)
+                raise
+            finally:
+                _current_invokes.reset(token)
+            self._record_call(method, args, kwargs, loop.time() - started, invokes, result=result)
+            return result
+        return wrapper
+
+    def _wrap_generator(self, method: str, original):
+        async def wrapper(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            items, invokes, latency, error = [], [], 0.0, None
+            iterator = original(*args, **kwargs)
+            try:
+                while True:
+                    # Only the generator's own steps count towards this call, not the consumer's work
+                    token = _current_invokes.set(invokes)
+                    started = loop.time()
+                    try:
+                        item = await iterator.__anext__()
+                    except StopAsyncIteration:
+                        break
+                    finally:
+                        latency += loop.time() - started
+                        _current_invokes.reset(token)
+                    items.append(item)
+                    yield item
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                # Record whatever the consumer saw, even if it stopped early
+                await iterator.aclose()
+                self._record_call(method, args, kwargs, latency, invokes, result=items, error=error)
+        return wrapper